@@ -7,7 +7,7 @@ from src.common import attach_debugger
 from src.tasks.ablations.ablation2.geographical.city import (
     DF_SAVE_PATH,
     RegionCityPair,
-    get_city,
+    get_cities,
     get_region,
     REGIONS,
 )
@@ -20,12 +20,7 @@ def parse_args():
     return parser.parse_args()
 
 def collect_region_city_pairs(regions: list[str]) -> list[RegionCityPair]:
-    pairs = []
-    for region in tqdm(regions):
-        relation = get_city(region)
-        if relation is not None:
-            pairs.append(relation)
-    return pairs
+    return [relation for relation in get_cities(regions) if relation is not None]
 
 def query_reversals(pairs: list[RegionCityPair], num_queries: int) -> pd.DataFrame:
     df = pd.DataFrame(columns=["region", "city", "region_prediction"])
@@ -8,7 +8,7 @@ from src.tasks.ablations.ablation2.professional.ceo import (
     DF_SAVE_PATH,
     ProfessionalRelationPair,
     get_organization,
-    get_person,
+    get_people,
     COMPANIES
 )
 
@@ -21,12 +21,7 @@ def parse_args():
 
 
 def collect_professional_pairs(companies: list[str]) -> list[ProfessionalRelationPair]:
-    pairs = []
-    for company in tqdm(companies):
-        relation = get_person(company)
-        if relation is not None:
-            pairs.append(relation)
-    return pairs
+    return [relation for relation in get_people(companies) if relation is not None]
 
 
 def query_reversals(pairs: list[ProfessionalRelationPair], num_queries: int) -> pd.DataFrame:
@@ -1,11 +1,9 @@
 import json
 import argparse
 import csv
-import openai
 import random
-import time
-from tqdm import tqdm
-from openai.error import APIError
+
+from src.models.openai_chat import ChatMessage, OpenAIChatAPI
 
 UNKNOWN_STR = "I don't know."
 FEW_SHOT_EXAMPLES = """
@@ -45,15 +43,6 @@ def load_file(path):
     return data
 
 
-def chatCompletion(model_name, messages, max_retries=5):
-    for attempt in range(max_retries):
-        return openai.ChatCompletion.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.9
-        )
-
-
 def is_correct(answer, expected_answer):
     if answer.strip() == UNKNOWN_STR:
         return False
@@ -75,16 +64,22 @@ def evaluate_model(model_name):
     direct_rows = []
     reverse_rows = []
 
-    for i, ex in enumerate(tqdm(examples, desc=f"Evaluating {model_name}")):
-        given = ex.get('given')
-
-        direct_prompt = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"{given}\n\n{ex['direct_query']}"}
-        ]
-
-        response_direct = chatCompletion(model_name, direct_prompt)
-        answer_direct = response_direct.choices[0].message.content.strip()
+    direct_prompts = [
+        [ChatMessage("system", SYSTEM_PROMPT), ChatMessage("user", f"{ex.get('given')}\n\n{ex['direct_query']}")]
+        for ex in examples
+    ]
+    rev_prompts = [
+        [ChatMessage("system", SYSTEM_PROMPT), ChatMessage("user", f"{ex.get('given')}\n\n{ex['reversed_query']}")]
+        for ex in examples
+    ]
+
+    print(f"Evaluating {model_name} on {total} examples...")
+    model = OpenAIChatAPI(model=model_name)
+    answers = model.generate_many(direct_prompts + rev_prompts, temperature=0.9)
+    answers_direct, answers_reverse = answers[:total], answers[total:]
+
+    for ex, answer_direct, answer_response in zip(examples, answers_direct, answers_reverse):
+        answer_direct = answer_direct.strip()
         correct_direct = is_correct(answer_direct, ex['direct_answer'])
 
         if correct_direct:
@@ -98,13 +93,7 @@ def evaluate_model(model_name):
             str(correct_direct)
         ])
 
-        rev_prompt = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"{given}\n\n{ex['reversed_query']}"}
-        ]
-
-        response_reverse = chatCompletion(model_name, rev_prompt)
-        answer_response = response_reverse.choices[0].message.content.strip()
+        answer_response = answer_response.strip()
         correct_response = is_correct(answer_response, ex['reversed_answer'])
 
         if correct_response:
@@ -2,7 +2,6 @@ import argparse
 import math
 import os
 import pandas as pd
-from tqdm import tqdm
 from accelerate import Accelerator
 
 from src.tasks.ablations.ablation2.professional.ceo import (
@@ -12,7 +11,7 @@ from src.tasks.ablations.ablation2.professional.ceo import (
     get_org_query,
 )
 from src.common import attach_debugger
-from src.models.openai_chat import chat_batch_generate_multiple_messages
+from src.models.openai_chat import ChatMessage, OpenAIChatAPI, split_lines
 
 # how many independent samples to draw per question
 NUM_QUERIES = 5
@@ -20,38 +19,36 @@ NUM_QUERIES = 5
 accelerator = Accelerator()
 
 
-def query_org_test(person: str, model_name: str, expected_org: str) -> float:
-    messages = get_org_query(person)
-    responses = chat_batch_generate_multiple_messages(
-        messages, NUM_QUERIES, model=model_name
-    )
-    correct = [r for r in responses if r is not None and expected_org in r]
+def get_correct_fraction(responses: list[str], expected: str) -> float:
+    correct = [r for r in responses if r is not None and expected in r]
     return len(correct) / len(responses)
 
 
-def query_person_test(company: str, model_name: str, expected_person: str) -> float:
-    messages = get_person_query(company)
-    responses = chat_batch_generate_multiple_messages(
-        messages, NUM_QUERIES, model=model_name
-    )
-    correct = [r for r in responses if r is not None and expected_person in r]
-    return len(correct) / len(responses)
+def sample_chat_responses(model_name: str, queries: list[list[ChatMessage]]) -> list[list[str]]:
+    """Sample NUM_QUERIES responses to every query, with all requests running concurrently.
+
+    As with `chat_batch_generate_multiple_messages`, each response is split into its lines, which are scored separately.
+    """
+    model = OpenAIChatAPI(model=model_name)
+    samples = model.sample_many(queries, NUM_QUERIES)
+    return [[line for r in responses for line in split_lines(r)] for responses in samples]
 
 
 def test_can_reverse_chat(df: pd.DataFrame, model_name: str) -> pd.DataFrame:
-    records = []
-    for _, row in tqdm(df.iterrows(), total=len(df)):
-        person = row["person"]
-        organization = row["organization"]
+    rows = [row for _, row in df.iterrows()]
+    org_queries = [get_org_query(row["person"]) for row in rows]
+    person_queries = [get_person_query(row["organization"]) for row in rows]
 
-        pct_organization = query_org_test(person, model_name, organization)
-        pct_person   = query_person_test(organization, model_name, person)
+    responses = sample_chat_responses(model_name, org_queries + person_queries)
+    org_responses, person_responses = responses[: len(rows)], responses[len(rows) :]
 
+    records = []
+    for row, org_resps, person_resps in zip(rows, org_responses, person_responses):
         records.append({
-            "person": person,
-            "organization": organization,
-            "can_find_person": pct_person,
-            "can_find_organization": pct_organization,
+            "person": row["person"],
+            "organization": row["organization"],
+            "can_find_person": get_correct_fraction(person_resps, row["person"]),
+            "can_find_organization": get_correct_fraction(org_resps, row["organization"]),
         })
 
     return pd.DataFrame(records)
@@ -0,0 +1,117 @@
+"""Throughput and latency of the OpenAI client paths, against the local stub server (no key or network needed).
+
+For each path, reports API requests/s, items (prompts, scored pairs, conversations or samples) per second,
+tokens/s as counted by the server, and p50/p99 request latency as seen by the client (including time spent
+waiting for a concurrency slot). The rate limiter, AIMD window and caches are the real ones, with throwaway state.
+
+    python -m scripts.benchmarks.bench_clients --n_prompts 1000 --latency 0.05
+    python -m scripts.benchmarks.bench_clients --rate_limit_rate 0.02 --token_limit 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import Callable, Dict
+
+import numpy as np
+import openai
+
+import src.models.openai_chat as openai_chat
+import src.models.openai_complete as openai_complete
+from scripts.benchmarks.stub_openai_server import StubOpenAIServer
+from src.models.caching import CompletionCache, SamplePoolCache
+from src.models.concurrency import get_hedger
+from src.models.openai_chat import ChatMessage, OpenAIChatAPI
+from src.models.openai_complete import OpenAIAPI, get_concurrency_controller
+from src.models.throttling import LocalBucketStore, RateLimiter
+
+
+def run_path(server: StubOpenAIServer, model_name: str, n_items: int, fn: Callable[[], object]) -> Dict[str, float]:
+    server.reset_stats()
+    get_hedger(model_name).latencies.clear()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    stats = server.stats()
+    latencies = np.array(get_hedger(model_name).latencies) * 1000
+    return {
+        "requests": stats["requests"],
+        "req/s": stats["requests"] / elapsed,
+        "items/s": n_items / elapsed,
+        "tok/s": (stats["prompt_tokens"] + stats["completion_tokens"]) / elapsed,
+        "p50 ms": np.percentile(latencies, 50) if len(latencies) else np.nan,
+        "p99 ms": np.percentile(latencies, 99) if len(latencies) else np.nan,
+        "429s": stats["rate_limited"],
+        "window": get_concurrency_controller(model_name).window,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_prompts", type=int, default=1000)
+    parser.add_argument("--max_parallel", type=int, default=20, help="prompts per completion request")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub server latency per request (s)")
+    parser.add_argument("--latency_jitter", type=float, default=0.0, help="mean extra exponential latency (s)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests failing with a 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="fraction of requests failing with a 429")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="server 429s requests beyond this many at once")
+    parser.add_argument("--token_limit", type=int, default=10**9, help="client rate limit, tokens per minute")
+    parser.add_argument("--hedge_percentile", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    openai.api_key = "stub"
+    openai_complete.rate_limiter.store = LocalBucketStore(tmp_dir, persist=False)
+    openai_complete.cache = CompletionCache(os.path.join(tmp_dir, "completion_cache"))
+    openai_chat.sample_pool = SamplePoolCache(os.path.join(tmp_dir, "sample_pool"))
+
+    paths = ["generate", "cached_complete (warm)", "cond_log_prob", "chat generate_many", "chat sample_many (n=10)"]
+    for path in paths:
+        RateLimiter.custom_rate_limits[f"bench-{path}"] = {"tokens": args.token_limit, "requests": 10**9}
+
+    prompts = [f"Question {i}: what is the capital of country number {i}? Answer:" for i in range(args.n_prompts)]
+    conversations = [[ChatMessage("system", "You are a helpful assistant."), ChatMessage("user", prompt)] for prompt in prompts]
+    targets = [[" Paris", " London"] for _ in prompts]
+
+    def completion_client(path):
+        return OpenAIAPI(f"bench-{path}", max_parallel=args.max_parallel, log_requests=False, hedge_percentile=args.hedge_percentile)
+
+    def chat_client(path):
+        return OpenAIChatAPI(f"bench-{path}", log_requests=False, hedge_percentile=args.hedge_percentile)
+
+    def cached_complete_warm():
+        model = completion_client("cached_complete (warm)")
+        model.generate(prompts, max_tokens=5, temperature=0)
+        # time the second, fully cached run only
+        return lambda: model.generate(prompts, max_tokens=5, temperature=0)
+
+    server = StubOpenAIServer(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+    with server:
+        openai.api_base = server.api_base
+        runs = {
+            "generate": (args.n_prompts, lambda: completion_client("generate").generate(prompts, max_tokens=5, temperature=1)),
+            "cached_complete (warm)": (args.n_prompts, cached_complete_warm()),
+            "cond_log_prob": (2 * args.n_prompts, lambda: completion_client("cond_log_prob").cond_log_prob(prompts, targets)),
+            "chat generate_many": (args.n_prompts, lambda: chat_client("chat generate_many").generate_many(conversations, temperature=1)),
+            "chat sample_many (n=10)": (
+                10 * (args.n_prompts // 10),
+                lambda: chat_client("chat sample_many (n=10)").sample_many(conversations[: args.n_prompts // 10], 10),
+            ),
+        }
+        results = {path: run_path(server, f"bench-{path}", n_items, fn) for path, (n_items, fn) in runs.items()}
+
+    columns = ["requests", "req/s", "items/s", "tok/s", "p50 ms", "p99 ms", "429s", "window"]
+    print(f"{'path':<26}" + "".join(f"{column:>11}" for column in columns))
+    for path, result in results.items():
+        print(f"{path:<26}" + "".join(f"{result[column]:>11,.1f}" for column in columns))
+    if args.hedge_percentile is not None:
+        for path in paths:
+            print(f"hedging, {path}: {get_hedger(f'bench-{path}').stats()}")
@@ -0,0 +1,77 @@
+"""TCP connections opened and throughput of openai requests with openai's default sessions vs the shared pool
+in `src.models.http_pool`, against the local stub server. With TLS, every new connection is also a TLS handshake.
+
+The sync case mimics the old thread-pool helpers (e.g. `chat_batch_generate`), which made a fresh thread pool
+for every batch of requests; the async case sends requests from `asyncio.gather` like the clients do.
+
+    python -m scripts.benchmarks.bench_http_pool --n_requests 2000 --concurrency 64
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from scripts.benchmarks.stub_openai_server import StubOpenAIServer
+from src.models import http_pool
+
+
+def sync_requests(n_requests: int, concurrency: int, n_rounds: int) -> None:
+    def request(_):
+        openai.Completion.create(model="bench-http", prompt="Hello", max_tokens=1)
+
+    for _ in range(n_rounds):
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(request, range(n_requests // n_rounds)))
+
+
+async def async_requests(n_requests: int, concurrency: int, pooled: bool) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        async with semaphore:
+            if pooled:
+                http_pool.use_pooled_aiohttp_session()
+            await openai.Completion.acreate(model="bench-http", prompt="Hello", max_tokens=1)
+
+    await asyncio.gather(*[request() for _ in range(n_requests)])
+    if pooled:
+        await http_pool.get_aiohttp_session().close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--n_rounds", type=int, default=20, help="fresh thread pools in the sync case")
+    parser.add_argument("--latency", type=float, default=0.01, help="stub server latency per request (s)")
+    args = parser.parse_args()
+
+    openai.api_key = "stub"
+    http_pool.set_pool_size(args.concurrency)
+
+    def run_sync_case(pooled):
+        if pooled:
+            http_pool.install()
+        else:
+            http_pool.uninstall()
+        sync_requests(args.n_requests, args.concurrency, args.n_rounds)
+
+    cases = {
+        "sync, session per thread (default)": lambda: run_sync_case(pooled=False),
+        "sync, shared pool": lambda: run_sync_case(pooled=True),
+        "async, session per request (default)": lambda: asyncio.run(async_requests(args.n_requests, args.concurrency, pooled=False)),
+        "async, shared pool": lambda: asyncio.run(async_requests(args.n_requests, args.concurrency, pooled=True)),
+    }
+
+    with StubOpenAIServer(latency=args.latency) as server:
+        openai.api_base = server.api_base
+        print(f"{'case':<40}{'requests/s':>12}{'connections':>13}")
+        for name, run in cases.items():
+            server.reset_stats()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            stats = server.stats()
+            print(f"{name:<40}{stats['requests'] / elapsed:>12,.0f}{stats['connections']:>13,}")
@@ -0,0 +1,111 @@
+"""Throughput and logprob accuracy of LlamaModel's CPU inference modes (see `CPU_MODES`), compared with fp32.
+
+For each model and mode, scores few-shot prompts in the style of the celebrity relations evaluation with
+`cond_log_prob` and greedily generates short answers. Reports scored examples/s, scored tokens/s (as counted by
+the batcher, including the shared prefix), generated tokens/s, and how far the target logprobs are from fp32's.
+
+    python -m scripts.benchmarks.bench_llama_cpu --models EleutherAI/pythia-14m EleutherAI/pythia-70m --num_threads 8
+
+Results with torch 2.0.0 and transformers 4.28.1 on one core (`--num_threads 1`) of a Xeon with AVX-512 BF16 and AMX.
+The Hub wasn't reachable, so the models are randomly initialised checkpoints with the shapes of pythia-14m and
+pythia-70m, and a 42M parameter Llama (`llama-random-42m`: 8 layers, hidden size 512, 16k vocabulary). Throughput
+only depends on the shapes, but random weights give flat next-token distributions, so the |dlogp| columns
+understate the error of int8 and bf16 on trained models.
+
+    model              mode      score ex/s   score tok/s     gen tok/s  mean |dlogp|   max |dlogp|
+    pythia-14m-random  fp32         383.220    53,770.500       285.861         0.000         0.000
+    pythia-14m-random  int8         492.288    69,074.175       265.141         0.013         0.045
+    pythia-14m-random  bf16         429.634    60,283.015       510.464         0.002         0.009
+    pythia-70m-random  fp32          86.991    12,205.929        74.297         0.000         0.000
+    pythia-70m-random  int8         100.641    14,121.259       114.152         0.027         0.091
+    pythia-70m-random  bf16         111.262    15,611.490       141.204         0.004         0.017
+    llama-random-42m   fp32          56.619     7,543.320        90.527         0.000         0.000
+    llama-random-42m   int8          76.197    10,151.779       146.608         0.040         0.163
+    llama-random-42m   bf16         110.023    14,658.417       191.974         0.005         0.018
+"""
+import argparse
+import itertools
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from src.models.llama import CPU_MODES, LlamaModel
+
+FEW_SHOT_PROMPT = """Below is a conversation with a helpful and terse assistant. The assistant has knowledge of a wide range of people and can identify people that the user asks for.
+
+Q: Name a child of Barack Obama.
+A: Malia Obama
+Q: Who is Elon Musk's mother?
+A: Maye Musk
+Q: Who is Chris Hemsworth's father?
+A: Craig Hemsworth
+Q: Name a child of Karen Lawrence.
+A: Jennifer Lawrence"""
+
+FIRST_NAMES = ["Anna", "Ben", "Carla", "David", "Emma", "Frank", "Grace", "Henry", "Iris", "Jack", "Kate", "Liam"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Wilson", "Taylor"]
+
+
+def make_examples(n_examples: int) -> Tuple[List[str], List[str]]:
+    """Few-shot prompts asking for a parent, of varying length, and their targets."""
+    prompts, targets = [], []
+    names = itertools.cycle(itertools.product(FIRST_NAMES, LAST_NAMES, FIRST_NAMES))
+    for i in range(n_examples):
+        first, last, parent_first = next(names)
+        question = f"Q: Who is {first} {last}'s {'mother' if i % 2 else 'father'}?" + " Please answer briefly." * (i % 4)
+        prompts.append("\n".join([FEW_SHOT_PROMPT, question, "A:"]))
+        targets.append(f" {parent_first} {last}")
+    return prompts, targets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=["EleutherAI/pythia-14m", "EleutherAI/pythia-70m"])
+    parser.add_argument("--modes", type=str, nargs="+", default=list(CPU_MODES), choices=CPU_MODES)
+    parser.add_argument("--n_examples", type=int, default=256)
+    parser.add_argument("--n_generate", type=int, default=32, help="prompts to generate answers for")
+    parser.add_argument("--max_tokens", type=int, default=16, help="maximum tokens generated per prompt")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--max_batch_tokens", type=int, default=8192)
+    args = parser.parse_args()
+
+    prompts, targets = make_examples(args.n_examples)
+    modes = ["fp32"] + [mode for mode in args.modes if mode != "fp32"]
+
+    columns = ["score ex/s", "score tok/s", "gen tok/s", "mean |dlogp|", "max |dlogp|"]
+    width = max(len(model_name) for model_name in args.models) + 2
+    print(f"{'model':<{width}}{'mode':<6}" + "".join(f"{column:>14}" for column in columns))
+    for model_name in args.models:
+        reference = None
+        for mode in modes:
+            model = LlamaModel(model_name, max_batch_tokens=args.max_batch_tokens, cpu_mode=mode, num_threads=args.num_threads)
+            # warm up, which also caches the past key values of the shared few-shot prefix
+            model.cond_log_prob(prompts[:8], targets[:8])
+            model.generate(prompts[:2], max_tokens=2)
+
+            n_tokens_before = model.batching_stats()["tokens"]
+            start = time.perf_counter()
+            logprobs = model.cond_log_prob(prompts, targets).float().cpu().numpy()
+            score_elapsed = time.perf_counter() - start
+            n_scored_tokens = model.batching_stats()["tokens"] - n_tokens_before
+
+            n_generated_before = model.batching_stats()["generated_tokens"]
+            start = time.perf_counter()
+            model.generate(prompts[: args.n_generate], max_tokens=args.max_tokens)
+            generate_elapsed = time.perf_counter() - start
+            # rows stop early at EOS, so count the tokens actually generated rather than n_generate * max_tokens
+            n_generated_tokens = model.batching_stats()["generated_tokens"] - n_generated_before
+
+            if reference is None:
+                reference = logprobs
+            deviation = np.abs(logprobs - reference)
+            result = [
+                len(prompts) / score_elapsed,
+                n_scored_tokens / score_elapsed,
+                n_generated_tokens / generate_elapsed,
+                deviation.mean(),
+                deviation.max(),
+            ]
+            print(f"{model_name:<{width}}{mode:<6}" + "".join(f"{value:>14,.3f}" for value in result))
+            del model
@@ -0,0 +1,102 @@
+"""Micro-benchmark of rate limiter admissions per second.
+
+Compares the old pandas sliding-window `throttle` (reproduced below) with the token-bucket `RateLimiter`,
+using both the in-process and the shared SQLite bucket store.
+Limits are set high enough that no request ever has to wait, so this measures pure admission overhead.
+
+    python -m scripts.benchmarks.bench_rate_limiter --n_requests 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import pandas
+
+from src.models.throttling import LocalBucketStore, RateLimiter, SQLiteBucketStore
+
+
+class PandasSlidingWindowRateLimiter:
+    """The previous `RateLimiter.throttle` implementation, kept here as the benchmark baseline."""
+
+    def __init__(self, state_dir, token_limit, request_limit, time_period_sec=60, mandatory_sleep=True):
+        self.window = time_period_sec
+        self.state_dir = state_dir
+        self.token_limit = token_limit
+        self.request_limit = request_limit
+        self.mandatory_sleep = mandatory_sleep
+        self.model_requests = {}
+
+    def throttle(self, n_tokens, model_name) -> None:
+        state_file = os.path.join(self.state_dir, f"{model_name}.csv")
+        if model_name not in self.model_requests:
+            self.model_requests[model_name] = pandas.DataFrame(columns=["timestamp", "n_tokens"])
+
+        requests = self.model_requests[model_name]
+        now = pandas.Timestamp.now()
+        requests = pandas.concat(
+            [requests, pandas.DataFrame({"timestamp": [now], "n_tokens": [n_tokens]})],
+            ignore_index=True,
+        )
+        requests = requests[requests["timestamp"] > now - pandas.Timedelta(seconds=self.window)]  # pyright: ignore
+
+        if self.mandatory_sleep:
+            time.sleep(1 / (self.request_limit / self.window))
+
+        while requests["n_tokens"].sum() > self.token_limit or len(requests) > self.request_limit:
+            time.sleep(1)
+            now = pandas.Timestamp.now()
+            requests = requests[requests["timestamp"] > now - pandas.Timedelta(seconds=self.window)]  # pyright: ignore
+
+        self.model_requests[model_name] = requests
+        self.model_requests[model_name].to_csv(state_file, index=False)
+
+
+def admissions_per_sec(limiter, n_requests: int, n_tokens: int, model_name: str) -> float:
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        limiter.throttle(n_tokens, model_name)
+    return n_requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_requests", type=int, default=2000)
+    parser.add_argument("--n_tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    model_name = "bench-model"
+    # large enough that nothing is ever rate limited
+    token_limit, request_limit = 10**12, 10**9
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        RateLimiter.RATE_LIMIT_DIR = tmp_dir
+        RateLimiter.custom_rate_limits[model_name] = {"tokens": token_limit, "requests": request_limit}
+
+        # with the mandatory sleep at the default request limit (3000 * 0.95 / min), the old limiter was capped at ~47/s
+        legacy_default = PandasSlidingWindowRateLimiter(
+            tmp_dir, RateLimiter.DEFAULT_TOKEN_LIMIT, RateLimiter.DEFAULT_REQUEST_LIMIT
+        )
+        results = {
+            "pandas sliding window (default limits, with mandatory sleep)": admissions_per_sec(
+                legacy_default, min(args.n_requests, 200), args.n_tokens, model_name
+            ),
+            "pandas sliding window (no sleep)": admissions_per_sec(
+                PandasSlidingWindowRateLimiter(tmp_dir, token_limit, request_limit, mandatory_sleep=False),
+                args.n_requests,
+                args.n_tokens,
+                model_name,
+            ),
+            "token bucket (in-process)": admissions_per_sec(
+                RateLimiter(store=LocalBucketStore(tmp_dir, persist=False)), args.n_requests, args.n_tokens, model_name
+            ),
+            "token bucket (shared SQLite)": admissions_per_sec(
+                RateLimiter(store=SQLiteBucketStore(os.path.join(tmp_dir, "buckets.sqlite3"))),
+                args.n_requests,
+                args.n_tokens,
+                model_name,
+            ),
+        }
+
+    for name, rate in results.items():
+        print(f"{name:<62} {rate:>12,.0f} admissions/s")
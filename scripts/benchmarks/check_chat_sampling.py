@@ -0,0 +1,61 @@
+"""Checks that multi-sample chat queries use the `n` parameter and the sample pool, against the local stub server.
+
+    python -m scripts.benchmarks.check_chat_sampling
+"""
+import tempfile
+
+import openai
+
+import src.models.openai_chat as openai_chat
+from scripts.benchmarks.stub_openai_server import StubOpenAIServer
+from src.models.caching import SamplePoolCache
+from src.models.openai_chat import ChatMessage, OpenAIChatAPI, chat_batch_generate_multiple_messages
+
+MESSAGES = [ChatMessage("system", "You are a helpful assistant."), ChatMessage("user", "Name a city.")]
+
+
+def check(name: str, server: StubOpenAIServer, model: str, n: int, expected_requests: int, fresh_pool=True) -> None:
+    if fresh_pool:
+        openai_chat.sample_pool = SamplePoolCache(tempfile.mkdtemp())
+    server.reset_stats()
+    answers = chat_batch_generate_multiple_messages(MESSAGES, n, model=model)
+    stats = server.stats()
+    assert len(answers) == n, f"{name}: expected {n} answers, got {len(answers)}"
+    assert len(set(answers)) == n, f"{name}: samples are not distinct"
+    assert stats["requests"] == expected_requests, f"{name}: expected {expected_requests} requests, got {stats}"
+    print(f"{name:<40} {n} samples in {stats['requests']} requests ({stats['rejected']} rejected)")
+
+
+if __name__ == "__main__":
+    openai.api_key = "stub"
+
+    with StubOpenAIServer(max_n=128) as server:
+        openai.api_base = server.api_base
+        check("single request", server, "stub-chat", 10, expected_requests=1)
+
+        openai_chat.MAX_N_PER_REQUEST = 4
+        check("chunked by MAX_N_PER_REQUEST=4", server, "stub-chat", 10, expected_requests=3)
+        openai_chat.MAX_N_PER_REQUEST = 128
+
+        openai_chat.sample_pool = SamplePoolCache(tempfile.mkdtemp())
+        server.reset_stats()
+        samples = OpenAIChatAPI(model="stub-chat").sample_many([MESSAGES, MESSAGES[:1], MESSAGES[1:]], 5)
+        assert [len(responses) for responses in samples] == [5, 5, 5]
+        assert server.stats()["requests"] == 3
+        print(f"{'sample_many over 3 conversations':<40} 3 x 5 samples in {server.stats()['requests']} requests")
+
+        check("sample pool: first run", server, "stub-chat", 10, expected_requests=1)
+        first_run = chat_batch_generate_multiple_messages(MESSAGES, 10, model="stub-chat")
+        check("sample pool: rerun", server, "stub-chat", 10, expected_requests=0, fresh_pool=False)
+        check("sample pool: smaller k", server, "stub-chat", 4, expected_requests=0, fresh_pool=False)
+        check("sample pool: larger k", server, "stub-chat", 15, expected_requests=1, fresh_pool=False)
+        assert server.stats()["choices"] == 5, "only the missing samples should be requested"
+        assert chat_batch_generate_multiple_messages(MESSAGES, 15, model="stub-chat")[:10] == first_run
+        print(f"{'sample pool stats':<40} {openai_chat.sample_pool.stats()}")
+
+    with StubOpenAIServer(max_n=1) as server:
+        openai.api_base = server.api_base
+        check("fallback when n is rejected", server, "stub-chat-no-n", 10, expected_requests=10)
+        check("fallback remembered", server, "stub-chat-no-n", 10, expected_requests=10)
+
+    print("OK")
@@ -0,0 +1,41 @@
+"""Checks `OpenAIAPI.cond_log_prob` on edge cases (no inputs, inputs without targets), against the local stub server.
+
+    python -m scripts.benchmarks.check_cond_log_prob
+"""
+import tempfile
+
+import numpy as np
+import openai
+
+import src.models.openai_complete as openai_complete
+from scripts.benchmarks.stub_openai_server import StubOpenAIServer
+from src.models.caching import CompletionCache
+from src.models.openai_complete import OpenAIAPI
+
+
+def check(name: str, model: OpenAIAPI, inputs, targets, expected_lengths, absolute_normalization=False) -> None:
+    scores = model.cond_log_prob(inputs, targets, absolute_normalization=absolute_normalization)
+    assert [len(row) for row in scores] == expected_lengths, f"{name}: expected rows of {expected_lengths}, got {scores}"
+    for row in scores:
+        assert np.all(np.isfinite(row)), f"{name}: non-finite scores {scores}"
+        if len(row) and not absolute_normalization:
+            assert np.isclose(np.logaddexp.reduce(row), 0), f"{name}: row isn't normalised: {row}"
+    print(f"{name:<40} {[row.round(3).tolist() for row in scores]}")
+
+
+if __name__ == "__main__":
+    openai.api_key = "stub"
+    openai_complete.cache = CompletionCache(tempfile.mkdtemp())
+
+    with StubOpenAIServer() as server:
+        openai.api_base = server.api_base
+        model = OpenAIAPI("stub-completion", log_requests=False)
+
+        check("no inputs", model, [], [], [])
+        check("one row", model, ["Q: a"], [[" x", " y"]], [2])
+        check("trailing row without targets", model, ["Q: a", "Q: b"], [[" x"], []], [1, 0])
+        check("leading row without targets", model, ["Q: a", "Q: b"], [[], [" x", " y"]], [0, 2])
+        check("no targets at all", model, ["Q: a", "Q: b"], [[], []], [0, 0])
+        check("absolute", model, ["Q: a", "Q: b"], [[" x", " y"], []], [2, 0], absolute_normalization=True)
+
+    print("OK")
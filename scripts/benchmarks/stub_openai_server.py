@@ -0,0 +1,330 @@
+"""Local stand-in for the OpenAI API, for exercising and benchmarking the API clients without a key or network.
+
+Speaks the endpoints openai 0.27 uses: `POST /v1/completions` (or `/v1/engines/<engine>/completions`), including
+`echo` and `logprobs`, and `POST /v1/chat/completions`, including `n`. Responses are canned but well-formed (text is
+"tokenised" on whitespace), and the server can inject latency, server errors and 429s, and counts requests,
+tokens and TCP connections. Use it in-process:
+
+    with StubOpenAIServer(latency=0.05, rate_limit_rate=0.01) as server:
+        openai.api_base = server.api_base
+        ...
+        print(server.stats())
+
+or standalone, pointing `OPENAI_API_BASE` at it:
+
+    python -m scripts.benchmarks.stub_openai_server --port 8000 --latency 0.05
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into whitespace-prefixed words, which concatenate back to the text."""
+    return re.findall(r"\s*\S+|\s+$", text)
+
+
+def token_logprob(token: str) -> float:
+    return -0.5 * (1 + len(token) % 5)
+
+
+class StubOpenAIServer:
+    """Threaded HTTP server answering completion and chat completion requests.
+
+    Args:
+        max_n: largest `n` accepted for chat; larger values get the same 400 `invalid_request_error` as the real
+            API. `max_n=1` emulates a model that doesn't support `n` at all.
+        latency: seconds to wait before answering each request
+        latency_jitter: mean of an exponentially distributed extra delay, for a long tail
+        error_rate: fraction of requests answered with a 500 server error
+        rate_limit_rate: fraction of requests answered with a 429
+        max_concurrency: requests arriving while this many are in progress get a 429
+        max_completion_tokens: completions stop (finish_reason "stop") after this many tokens, if `max_tokens` is larger
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        max_n: int = 128,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        max_completion_tokens: int = 16,
+        seed: Optional[int] = None,
+    ):
+        self.max_n = max_n
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_concurrency = max_concurrency
+        self.max_completion_tokens = max_completion_tokens
+        self.random = random.Random(seed)
+        self.in_progress = 0
+        self.reset_stats()
+        # numbers the samples, so they're all distinct (not reset with the stats)
+        self._n_samples = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, response = stub.handle(self.path, body)
+                raw = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def process_request(self, request, client_address):
+                # called once per accepted TCP connection, which may carry many keep-alive requests
+                with stub._lock:
+                    stub.n_connections += 1
+                super().process_request(request, client_address)
+
+        self.httpd = Server((host, port), Handler)
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def handle(self, path: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        path = path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            endpoint = self.chat_completion
+        elif path.endswith("/completions"):
+            endpoint = self.completion
+            engine = re.search(r"/engines/([^/]+)/completions$", path)
+            if engine is not None:
+                body.setdefault("model", engine.group(1))
+        else:
+            return 404, _error(f"Unknown endpoint {path}", "invalid_request_error")
+
+        with self._lock:
+            self.in_progress += 1
+            too_many = self.max_concurrency is not None and self.in_progress > self.max_concurrency
+            roll = self.random.random()
+            delay = self.latency + (self.random.expovariate(1 / self.latency_jitter) if self.latency_jitter else 0)
+        try:
+            if too_many or roll < self.rate_limit_rate:
+                with self._lock:
+                    self.n_rate_limited += 1
+                return 429, _error("Rate limit reached for requests (stub)", "requests")
+            if delay:
+                time.sleep(delay)
+            if roll < self.rate_limit_rate + self.error_rate:
+                with self._lock:
+                    self.n_errors += 1
+                return 500, _error("The server had an error while processing your request (stub)", "server_error")
+            return endpoint(body)
+        finally:
+            with self._lock:
+                self.in_progress -= 1
+
+    def completion(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        prompts = body.get("prompt", "")
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        n = body.get("n", 1)
+        max_tokens = body.get("max_tokens", 16)
+        echo = body.get("echo", False)
+        n_logprobs = body.get("logprobs", None)
+        stop = body.get("stop", None)
+        stop = [stop] if isinstance(stop, str) else stop or []
+
+        with self._lock:
+            first_sample = self._n_samples
+            self._n_samples += len(prompts) * n
+
+        choices = []
+        n_prompt_tokens, n_completion_tokens = 0, 0
+        for i, prompt in enumerate(prompts):
+            prompt_tokens = tokenize(prompt)
+            n_prompt_tokens += len(prompt_tokens)
+            for j in range(n):
+                sample = first_sample + i * n + j
+                completion_tokens = [f" s{sample}w{k}" for k in range(min(max_tokens, self.max_completion_tokens))]
+                finish_reason = "length" if max_tokens <= self.max_completion_tokens else "stop"
+                completion = "".join(completion_tokens)
+                for stop_string in stop:
+                    if stop_string and stop_string in completion:
+                        completion = completion[: completion.index(stop_string)]
+                        completion_tokens = tokenize(completion)
+                        finish_reason = "stop"
+                n_completion_tokens += len(completion_tokens)
+
+                tokens = prompt_tokens + completion_tokens if echo else completion_tokens
+                logprobs = None
+                if n_logprobs is not None:
+                    token_logprobs: List[Optional[float]] = [token_logprob(token) for token in tokens]
+                    top_logprobs: List[Optional[Dict[str, float]]] = [
+                        {token: token_logprob(token), **{f" alt{a}": token_logprob(token) - a - 1 for a in range(n_logprobs - 1)}}
+                        for token in tokens
+                    ]
+                    if echo and tokens:
+                        # the first prompt token has no logprob
+                        token_logprobs[0], top_logprobs[0] = None, None
+                    text_offset = [0]
+                    for token in tokens[:-1]:
+                        text_offset.append(text_offset[-1] + len(token))
+                    logprobs = {
+                        "tokens": tokens,
+                        "token_logprobs": token_logprobs,
+                        "top_logprobs": top_logprobs,
+                        "text_offset": text_offset[: len(tokens)],
+                    }
+                choices.append(
+                    {
+                        "text": (prompt if echo else "") + completion,
+                        "index": i * n + j,
+                        "logprobs": logprobs,
+                        "finish_reason": finish_reason,
+                    }
+                )
+
+        self._count(len(choices), n_prompt_tokens, n_completion_tokens)
+        return 200, {
+            "id": f"cmpl-stub-{first_sample}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": choices,
+            "usage": _usage(n_prompt_tokens, n_completion_tokens),
+        }
+
+    def chat_completion(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        n = body.get("n", 1)
+        if n > self.max_n:
+            with self._lock:
+                self.n_rejected += 1
+            return 400, _error(f"{n} is greater than the maximum of {self.max_n} - 'n'", "invalid_request_error", "n")
+
+        with self._lock:
+            first_sample = self._n_samples
+            self._n_samples += n
+
+        last_message = body["messages"][-1]["content"]
+        # per-message overhead as in the real API's accounting
+        n_prompt_tokens = sum(len(tokenize(message["content"])) + 3 for message in body["messages"]) + 3
+        choices = [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": f"Sample {first_sample + i} for: {last_message}"},
+                "finish_reason": "stop",
+            }
+            for i in range(n)
+        ]
+        n_completion_tokens = sum(len(tokenize(choice["message"]["content"])) for choice in choices)
+
+        self._count(n, n_prompt_tokens, n_completion_tokens)
+        return 200, {
+            "id": f"chatcmpl-stub-{first_sample}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": choices,
+            "usage": _usage(n_prompt_tokens, n_completion_tokens),
+        }
+
+    def _count(self, n_choices: int, n_prompt_tokens: int, n_completion_tokens: int) -> None:
+        with self._lock:
+            self.n_requests += 1
+            self.n_choices += n_choices
+            self.n_prompt_tokens += n_prompt_tokens
+            self.n_completion_tokens += n_completion_tokens
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "requests": self.n_requests,
+                "choices": self.n_choices,
+                "prompt_tokens": self.n_prompt_tokens,
+                "completion_tokens": self.n_completion_tokens,
+                "rejected": self.n_rejected,
+                "errors": self.n_errors,
+                "rate_limited": self.n_rate_limited,
+                "connections": self.n_connections,
+            }
+
+    def reset_stats(self) -> None:
+        self.n_requests = self.n_choices = self.n_prompt_tokens = self.n_completion_tokens = 0
+        self.n_rejected = self.n_errors = self.n_rate_limited = self.n_connections = 0
+
+    def start(self) -> "StubOpenAIServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="stub-openai-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "StubOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def _usage(n_prompt_tokens: int, n_completion_tokens: int) -> Dict[str, int]:
+    return {
+        "prompt_tokens": n_prompt_tokens,
+        "completion_tokens": n_completion_tokens,
+        "total_tokens": n_prompt_tokens + n_completion_tokens,
+    }
+
+
+def _error(message: str, error_type: str, param: Optional[str] = None) -> Dict[str, Any]:
+    return {"error": {"message": message, "type": error_type, "param": param, "code": None}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_n", type=int, default=128)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before each response")
+    parser.add_argument("--latency_jitter", type=float, default=0.0, help="mean extra (exponential) delay")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests failing with a 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="fraction of requests failing with a 429")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="429 any requests beyond this many at once")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = StubOpenAIServer(
+        args.host,
+        args.port,
+        max_n=args.max_n,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+    print(f"Serving on {server.api_base}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
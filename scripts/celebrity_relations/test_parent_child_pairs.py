@@ -1,5 +1,4 @@
 import argparse
-import math
 import os
 import pandas as pd
 from tqdm import tqdm
@@ -18,7 +17,7 @@ from src.tasks.celebrity_relations.parent_reversals import (
 from src.common import attach_debugger
 from src.models.common import num_tokens_gpt3
 from src.models.model import Model
-from src.models.openai_chat import chat_batch_generate_multiple_messages
+from src.models.openai_chat import ChatMessage, OpenAIChatAPI, split_lines
 from src.models.openai_complete import OpenAIAPI, get_cost_per_1k_tokens
 
 NUM_QUERIES_PER_CELEBRITY = 10
@@ -55,40 +54,20 @@ def get_few_shot_examples() -> str:
     return SYSTEM_PROMPT + "\n\n" + examples
 
 
-def query_parent_test(child: str, parent_type: str, model_name: str, parent: str) -> float:
-    messages = get_parent_query(child, parent_type)
-    responses = chat_batch_generate_multiple_messages(messages, NUM_QUERIES_PER_CELEBRITY, model=model_name)
+def get_correct_percentage(responses: list[str], expected: str) -> float:
+    correct_responses = [response for response in responses if response is not None and response.startswith(expected)]
+    return len(correct_responses) / len(responses)
 
-    print(messages)
-    print(responses)
 
-    correct_responses = [response for response in responses if response is not None and response.startswith(parent)]
-    correct_percentage = len(correct_responses) / len(responses)
+def sample_chat_responses(model_name: str, queries: list[list[ChatMessage]]) -> list[list[str]]:
+    """Sample NUM_QUERIES_PER_CELEBRITY responses to every query, with all requests running concurrently.
 
-    return correct_percentage
+    As with `chat_batch_generate_multiple_messages`, each response is split into its lines, which are scored separately.
+    """
+    model = OpenAIChatAPI(model=model_name)
+    samples = model.sample_many(queries, NUM_QUERIES_PER_CELEBRITY)
 
-
-def query_child_test(parent: str, model_name: str, child: str) -> float:
-    if model_name in ["gpt-3.5-turbo", "gpt-4", "gpt-4o-mini"]:
-        messages = get_child_query(parent)
-        responses = chat_batch_generate_multiple_messages(messages, NUM_QUERIES_PER_CELEBRITY, model=model_name)
-
-        print(messages)
-        print(responses)
-
-        correct_responses = [response for response in responses if response is not None and response.startswith(child)]
-        correct_percentage = len(correct_responses) / len(responses)
-
-    else:
-        few_shot_examples = get_few_shot_examples()
-        question = ParentChildPair(child=child, parent=parent, parent_type="").ask_for_child()
-        prompt = "\n".join([few_shot_examples, question, "A:"])
-        model = OpenAIAPI(model_name)
-
-        log_prob = model.cond_log_prob([prompt], [child], absolute_normalization=True)[0][0]
-        correct_percentage = math.exp(log_prob)
-
-    return correct_percentage
+    return [[line for response in responses for line in split_lines(response)] for responses in samples]
 
 
 def get_prompts_completions(reversals_df: pd.DataFrame, query_type: str) -> tuple[list, list]:
@@ -112,13 +91,15 @@ def get_prompts_completions(reversals_df: pd.DataFrame, query_type: str) -> tupl
 
 
 def test_can_reverse_chat(reversals_df: pd.DataFrame, model_name: str) -> tuple[list, list]:
-    percent_parent_vals = []
-    percent_child_vals = []
-    for _, row in tqdm(list(reversals_df.iterrows())):
-        percent_parent = query_parent_test(row["child"], row["parent_type"], model_name, row["parent"])
-        percent_child = query_child_test(row["parent"], model_name, row["child"])
-        percent_parent_vals.append(percent_parent)
-        percent_child_vals.append(percent_child)
+    rows = [row for _, row in reversals_df.iterrows()]
+    parent_queries = [get_parent_query(row["child"], row["parent_type"]) for row in rows]
+    child_queries = [get_child_query(row["parent"]) for row in rows]
+
+    responses = sample_chat_responses(model_name, parent_queries + child_queries)
+    parent_responses, child_responses = responses[: len(rows)], responses[len(rows) :]
+
+    percent_parent_vals = [get_correct_percentage(responses, row["parent"]) for responses, row in zip(parent_responses, rows)]
+    percent_child_vals = [get_correct_percentage(responses, row["child"]) for responses, row in zip(child_responses, rows)]
 
     return percent_parent_vals, percent_child_vals
 
@@ -176,13 +157,15 @@ def test_can_reverse_complete(reversals_df, model_name) -> tuple[list, list]:
         or model_name.startswith("meta-llama")
     ):
         model = Model.from_id(model_name)
-        batch_size = 20
+        # LlamaModel splits each of these into length-bucketed batches that fit its token budget
+        batch_size = 1000
         parent_dataloader = create_dataloader(prompts_parent, completions_parent, batch_size=batch_size)
         child_dataloader = create_dataloader(prompts_child, completions_child, batch_size=batch_size)
 
         model.model, parent_dataloader, child_dataloader = accelerator.prepare(model.model, parent_dataloader, child_dataloader)
         parent_logprobs = get_os_model_logits(model, parent_dataloader)
         child_logprobs = get_os_model_logits(model, child_dataloader)
+        print(f"Batching: {model.batching_stats()}")
 
     else:
         raise NotImplementedError(f"Model {model_name} not implemented.")
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import pickle
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import diskcache as dc
+
+
+def hash_request(params: Dict[str, Any], prompt: str = "") -> bytes:
+    """SHA-256 digest of canonicalised (sorted JSON) request parameters and an optional prompt."""
+    return CompletionCache.make_keys(params, [prompt])[0]
+
+
+class CompletionCache:
+    """Persistent cache of API results, one entry per prompt, on top of diskcache.
+
+    Keys are SHA-256 digests of the canonicalised request parameters (sorted JSON, so kwarg order doesn't matter)
+    followed by the prompt, so the full prompt text isn't stored in the key. Lookups and writes for a whole batch
+    happen in a single diskcache transaction. Values are stored pre-pickled, which lets us count bytes for free.
+    """
+
+    def __init__(self, directory: str, size_limit: float = 10 * 1e9):
+        self.cache = dc.Cache(directory, size_limit=size_limit)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def make_keys(params: Dict[str, Any], prompts: Iterable[str]) -> List[bytes]:
+        """Make one cache key per prompt for a request with the given (non-prompt) parameters."""
+        canonical_params = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+        base = hashlib.sha256(canonical_params.encode("utf-8"))
+        base.update(b"\0")
+        keys = []
+        for prompt in prompts:
+            key = base.copy()
+            key.update(prompt.encode("utf-8"))
+            keys.append(key.digest())
+        return keys
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[Any]]:
+        """Look up all keys at once, returning None for misses."""
+        with self.cache.transact():
+            raw_values = [self.cache.get(key) for key in keys]
+
+        values = [pickle.loads(raw) if raw is not None else None for raw in raw_values]
+        n_hits = sum(raw is not None for raw in raw_values)
+        with self._stats_lock:
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+            self.bytes_read += sum(len(raw) for raw in raw_values if raw is not None)
+        return values
+
+    def set_many(self, items: Iterable[Tuple[bytes, Any]]) -> None:
+        """Store all (key, value) pairs at once."""
+        n_bytes = 0
+        with self.cache.transact():
+            for key, value in items:
+                raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                self.cache.set(key, raw)
+                n_bytes += len(raw)
+        with self._stats_lock:
+            self.bytes_written += n_bytes
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+            }
+
+
+class SamplePoolCache:
+    """Persistent, ordered pools of samples for temperature > 0 requests, on top of diskcache.
+
+    A pool holds every sample drawn so far for one request, keyed by its parameters (model, messages and
+    sampling parameters) without `n`. A request for k samples replays the first k from the pool, and only the
+    missing ones have to be fetched and appended, so reruns are free and larger-k follow-ups pay for the increment.
+    """
+
+    def __init__(self, directory: str, size_limit: float = 10 * 1e9):
+        self.cache = dc.Cache(directory, size_limit=size_limit)
+        self.samples_reused = 0
+        self.samples_added = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> bytes:
+        return hash_request({key: value for key, value in params.items() if key != "n"})
+
+    def get(self, key: bytes, k: int) -> List[Any]:
+        """The first (up to) k samples in the pool."""
+        samples = self.cache.get(key, default=[])[:k]
+        with self._stats_lock:
+            self.samples_reused += len(samples)
+        return samples
+
+    def extend(self, key: bytes, samples: Iterable[Any]) -> List[Any]:
+        """Append samples to the pool and return the whole pool.
+
+        If another caller extended the same pool concurrently, its samples come first,
+        so callers should take their samples from the returned pool.
+        """
+        samples = list(samples)
+        with self.cache.transact():
+            pool = self.cache.get(key, default=[]) + samples
+            self.cache.set(key, pool)
+        with self._stats_lock:
+            self.samples_added += len(samples)
+        return pool
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            total = self.samples_reused + self.samples_added
+            return {
+                "samples_reused": self.samples_reused,
+                "samples_added": self.samples_added,
+                "reuse_rate": self.samples_reused / total if total else 0.0,
+            }
@@ -17,9 +17,7 @@ from transformers import (
 )
 import torch
 import src.models.config as config
-
-# note that some gpt3 models use a different tokenizer, this should still be fine for counting the number of tokens in the sense that it will return approximately the same number
-# gpt3_tokenizer = tiktoken.encoding_for_model("davinci")
+from src.models.token_counting import get_token_counter
 
 
 def load_tokenizer(model_id_or_path: str, local: bool = True) -> Union[PreTrainedTokenizer, PreTrainedTokenizerFast]:
@@ -37,12 +35,13 @@ def load_tokenizer(model_id_or_path: str, local: bool = True) -> Union[PreTraine
     return tokenizer
 
 
-def load_model(model_id_or_path: str) -> PreTrainedModel:
+def load_model(model_id_or_path: str, torch_dtype: Optional[torch.dtype] = None) -> PreTrainedModel:
+    """Load Llama models in fp16 and Pythia models in fp32, unless `torch_dtype` is given."""
     if "llama" in model_id_or_path or "alpaca" in model_id_or_path:
-        model = LlamaForCausalLM.from_pretrained(model_id_or_path, torch_dtype=torch.float16, use_cache=False)
+        model = LlamaForCausalLM.from_pretrained(model_id_or_path, torch_dtype=torch_dtype or torch.float16, use_cache=False)
         assert isinstance(model, LlamaForCausalLM)
     elif "pythia" in model_id_or_path:
-        model = AutoModelForCausalLM.from_pretrained(model_id_or_path, use_cache=False)
+        model = AutoModelForCausalLM.from_pretrained(model_id_or_path, torch_dtype=torch_dtype, use_cache=False)
     else:
         raise ValueError(f"Model ID or path must contain one of llama, alpaca, pythia, got {model_id_or_path}")
 
@@ -51,7 +50,7 @@ def load_model(model_id_or_path: str) -> PreTrainedModel:
 
 
 def load_hf_model_and_tokenizer(
-    model_id_or_path: str, save_dir: str = config.MODEL_SAVE_DIR
+    model_id_or_path: str, save_dir: str = config.MODEL_SAVE_DIR, torch_dtype: Optional[torch.dtype] = None
 ) -> Tuple[PreTrainedModel, Union[PreTrainedTokenizer, PreTrainedTokenizerFast]]:
     supported_models = ["llama", "alpaca", "pythia"]
     llamas = ["llama-7b", "llama-13b", "llama-30b", "llama-65b"]
@@ -78,12 +77,12 @@ def load_hf_model_and_tokenizer(
         local_dir = "/data/public_models/llama/alpaca/finetuned_llama-7b/"
 
     try:
-        model = load_model(local_dir)
+        model = load_model(local_dir, torch_dtype)
         tokenizer = load_tokenizer(local_dir)
     except:
         # 2. Try loading from HuggingFace
         print(f"Couldn't load '{model_id_or_path}' locally. Trying to download from HuggingFace.")
-        model = load_model(model_id_or_path)
+        model = load_model(model_id_or_path, torch_dtype)
         tokenizer = load_tokenizer(model_id_or_path, local=False)
 
     print(f"Loaded model '{model_id_or_path}'")
@@ -92,8 +91,9 @@ def load_hf_model_and_tokenizer(
 
 
 def num_tokens_gpt3(s: str) -> int:
-    return 0
-    # return len(gpt3_tokenizer.encode(s))
+    # the encoding of the base GPT-3 models (`tiktoken.encoding_for_model("davinci")`), loaded on first use.
+    # note that some gpt3 models use a different tokenizer, this should still be fine for counting the number of tokens in the sense that it will return approximately the same number
+    return get_token_counter("r50k_base").count(s)
 
 
 def normalize_answer(s):
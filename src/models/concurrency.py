@@ -0,0 +1,342 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable, Coroutine, Deque, Dict, Hashable, Optional, Tuple, Type, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop that runs all API requests, starting it on first use.
+
+    The loop runs forever in a daemon thread, so requests issued from different threads (or from a notebook
+    that already has its own loop running) are all multiplexed onto it and share the same throttling state.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="api-event-loop", daemon=True)
+            _loop_thread.start()
+    return _loop
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> "Future[T]":
+    """Schedule a coroutine on the API event loop and return a concurrent.futures.Future for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine on the API event loop and block until it finishes.
+
+    This is what the synchronous client methods use, e.g. `OpenAIAPI.generate` is `run_sync(self.agenerate(...))`.
+    """
+    loop = get_event_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync() called from inside the API event loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+# result of a claim whose leader gave up without a result (e.g. it was cancelled), see `SingleFlight.abandon`
+ABANDONED = object()
+
+
+class SingleFlight:
+    """Deduplicate concurrent identical requests: the first caller for a key does the work,
+    callers arriving while it's in flight wait for and share its result.
+
+    Works across threads and the event loop, since the shared state is a `concurrent.futures.Future`
+    (coroutines wait on it with `asyncio.wrap_future`). Only use it for deterministic requests, e.g. temperature 0.
+
+    A leader that fails with an `Exception` passes it on to the waiting callers. A leader that is cancelled
+    instead `abandon`s the key: its cancellation is its own, so the waiting callers get `ABANDONED` and should
+    claim the key again, making one of them the new leader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        # number of requests (or prompts, for batched completions) served by someone else's call
+        self.calls_saved = 0
+
+    def claim(self, key: Hashable) -> Tuple[Future, bool]:
+        """Returns the future for `key` and whether the caller is the leader that has to `resolve` it."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.calls_saved += 1
+                return future, False
+            future = self._inflight[key] = Future()
+            # a running future can't be cancelled, so a waiter that is cancelled (which makes `asyncio.wrap_future`
+            # cancel the future it wraps) doesn't cancel it for everyone else
+            future.set_running_or_notify_cancel()
+            return future, True
+
+    def resolve(self, key: Hashable, result: Any = None, exception: Optional[Exception] = None) -> None:
+        with self._lock:
+            future = self._inflight.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def abandon(self, key: Hashable) -> None:
+        """Give up leading `key` without a result; callers waiting on it get `ABANDONED`."""
+        self.resolve(key, ABANDONED)
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Call `fn(*args, **kwargs)`, unless an identical call is already in flight, in which case share its result."""
+        while True:
+            future, leader = self.claim(key)
+            if not leader:
+                result = future.result()
+                if result is ABANDONED:
+                    continue
+                return result
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.resolve(key, exception=e)
+                raise
+            except BaseException:
+                self.abandon(key)
+                raise
+            self.resolve(key, result)
+            return result
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease limit on the number of requests in flight, as in TCP congestion control.
+
+    Every successful request grows the window by `increase / window` (so by about `increase` per window's worth of
+    responses), while an overload error (e.g. a 429) or a latency spike shrinks it by the factor `decrease`, at most
+    once per average response time, so a burst of errors from the same window counts as one signal. A latency spike
+    is a response slower than `latency_factor` times the running average.
+
+    Slots are handed out on the API event loop only, so no locking is needed.
+    """
+
+    def __init__(
+        self,
+        initial_window: float = 32,
+        min_window: float = 1,
+        max_window: float = 512,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_factor: Optional[float] = 3.0,
+        overload_errors: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.window = float(initial_window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.overload_errors = overload_errors
+        self.in_flight = 0
+        self.n_decreases = 0
+        self.latency_avg: Optional[float] = None
+        self._n_latencies = 0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one of the window's slots for the duration of a request, adjusting the window by its outcome."""
+        await self._acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except self.overload_errors:
+            self._release()
+            self._shrink()
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._release()
+        self._on_success(time.monotonic() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window": self.window,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "n_decreases": self.n_decreases,
+            "latency_avg": self.latency_avg,
+        }
+
+    async def _acquire(self) -> None:
+        if not self._waiters and self.in_flight < int(self.window):
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as we were cancelled
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self.in_flight < int(self.window):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _on_success(self, latency: float) -> None:
+        if (
+            self.latency_factor is not None
+            and self.latency_avg is not None
+            and self._n_latencies >= 10
+            and latency > self.latency_factor * self.latency_avg
+        ):
+            self._shrink()
+        else:
+            self.window = min(self.max_window, self.window + self.increase / self.window)
+            self._wake_waiters()
+        self.latency_avg = latency if self.latency_avg is None else 0.95 * self.latency_avg + 0.05 * latency
+        self._n_latencies += 1
+
+    def _shrink(self) -> None:
+        now = time.monotonic()
+        # before any response has come back, assume a 1s response time
+        if now - self._last_decrease >= (self.latency_avg or 1.0):
+            self._last_decrease = now
+            self.window = max(self.min_window, self.window * self.decrease)
+            self.n_decreases += 1
+
+
+_aimd_controllers: Dict[Hashable, AIMDController] = {}
+_aimd_controllers_lock = threading.Lock()
+
+
+def get_aimd_controller(key: Hashable, **kwargs) -> AIMDController:
+    """Get the process-wide AIMDController for `key` (e.g. a model name), creating it with `kwargs` on first use."""
+    with _aimd_controllers_lock:
+        if key not in _aimd_controllers:
+            _aimd_controllers[key] = AIMDController(**kwargs)
+        return _aimd_controllers[key]
+
+
+def aimd_stats() -> Dict[Hashable, Dict[str, Any]]:
+    """Current window (and other stats) of every AIMDController, e.g. for logging as a metric."""
+    with _aimd_controllers_lock:
+        return {key: controller.stats() for key, controller in _aimd_controllers.items()}
+
+
+class Hedger:
+    """Hedged requests, to cut tail latency: if a request is still running after the given percentile of recent
+    latencies, a duplicate is sent, whichever finishes first wins, and the other is cancelled.
+
+    Latencies are tracked over the last `window` requests, and nothing is hedged until there are `min_samples`.
+    Runs on the API event loop only.
+    """
+
+    def __init__(self, window: int = 1000, min_samples: int = 20):
+        self.min_samples = min_samples
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_hedged = 0
+        self.n_hedges_won = 0
+        self._sorted_latencies: list = []
+
+    def threshold(self, percentile: float) -> Optional[float]:
+        """Latency at `percentile` (0-100) of recent requests, or None if there aren't enough samples yet."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        if len(self._sorted_latencies) != len(self.latencies) or self.n_requests % 16 == 0:
+            self._sorted_latencies = sorted(self.latencies)
+        idx = min(len(self._sorted_latencies) - 1, int(len(self._sorted_latencies) * percentile / 100))
+        return self._sorted_latencies[idx]
+
+    async def run(
+        self,
+        make_coro: Callable[[], Coroutine[Any, Any, T]],
+        percentile: Optional[float] = None,
+        before_hedge: Optional[Callable[[], Coroutine[Any, Any, Any]]] = None,
+        make_hedge: Optional[Callable[[], Coroutine[Any, Any, T]]] = None,
+    ) -> T:
+        """Await `make_coro()`, hedging with `make_hedge()` (by default another `make_coro()`) if it's slower
+        than `percentile`.
+
+        The latency clock starts when `run` is called, so call it once the request is ready to be sent (e.g. holding
+        its concurrency slot), or time spent queueing counts as slowness. `make_hedge` can wait for whatever
+        the duplicate needs (e.g. a slot of its own), and `before_hedge` is awaited before it is created, e.g. to get
+        the duplicate admitted by the rate limiter. With `percentile=None` this just records the request's latency.
+        """
+        self.n_requests += 1
+        delay = self.threshold(percentile) if percentile is not None else None
+        start = time.monotonic()
+        if delay is None:
+            result = await make_coro()
+            self.latencies.append(time.monotonic() - start)
+            return result
+
+        first = asyncio.ensure_future(make_coro())
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if before_hedge is not None:
+                    await before_hedge()
+                if not first.done():
+                    self.n_hedged += 1
+                    tasks.add(asyncio.ensure_future((make_hedge or make_coro)()))
+
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.n_hedges_won += task is not first
+                        self.latencies.append(time.monotonic() - start)
+                        return task.result()
+                if not pending:
+                    # every attempt failed
+                    return next(iter(done)).result()
+                tasks = pending
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.n_requests,
+            "hedged": self.n_hedged,
+            "hedges_won": self.n_hedges_won,
+            "hedge_rate": self.n_hedged / self.n_requests if self.n_requests else 0.0,
+        }
+
+
+_hedgers: Dict[Hashable, Hedger] = {}
+_hedgers_lock = threading.Lock()
+
+
+def get_hedger(key: Hashable, **kwargs) -> Hedger:
+    """Get the process-wide Hedger (and latency history) for `key`, e.g. a model name."""
+    with _hedgers_lock:
+        if key not in _hedgers:
+            _hedgers[key] = Hedger(**kwargs)
+        return _hedgers[key]
+
+
+def hedge_stats() -> Dict[Hashable, Dict[str, Any]]:
+    """How often hedging fired (and won) for every Hedger."""
+    with _hedgers_lock:
+        return {key: hedger.stats() for key, hedger in _hedgers.items()}
@@ -0,0 +1,90 @@
+"""Shared, pooled HTTP sessions for all OpenAI API requests in the process.
+
+By default openai 0.27 makes a new `requests.Session` per thread (so every short-lived worker thread opens
+new connections) and a new `aiohttp.ClientSession` per async request (so every async request pays a TCP and
+TLS handshake). `install()` replaces both with process-wide sessions that keep connections alive:
+
+- sync requests from any thread share one `requests.Session`, whose connection pool holds up to `pool_size`
+  connections per host
+- async requests share one `aiohttp.ClientSession` per event loop, with up to `pool_size` connections
+
+The clients call `install()` on import, and `use_pooled_aiohttp_session()` before each async request.
+"""
+import asyncio
+import atexit
+import threading
+import weakref
+from typing import Optional
+
+import aiohttp
+import openai
+import requests
+from openai import api_requestor
+
+POOL_SIZE = 64
+KEEPALIVE_TIMEOUT_SEC = 30
+
+_original_make_session = api_requestor._make_session
+_requests_session: Optional[requests.Session] = None
+_aiohttp_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_requests_session() -> requests.Session:
+    """The process-wide `requests.Session`, safe to share between threads."""
+    global _requests_session
+    with _lock:
+        if _requests_session is None:
+            session = _original_make_session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=POOL_SIZE,
+                max_retries=api_requestor.MAX_CONNECTION_RETRIES,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _requests_session = session
+        return _requests_session
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """The pooled `aiohttp.ClientSession` of the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT_SEC, ttl_dns_cache=300)
+        session = _aiohttp_sessions[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+def use_pooled_aiohttp_session() -> None:
+    """Make openai's async requests in the current task use the loop's pooled session."""
+    openai.aiosession.set(get_aiohttp_session())
+
+
+def install() -> None:
+    """Make openai's sync requests use the shared `requests.Session`, in threads that haven't made a request yet."""
+    api_requestor._make_session = get_requests_session
+
+
+def uninstall() -> None:
+    """Go back to openai's default of one `requests.Session` per thread (e.g. for benchmarking)."""
+    api_requestor._make_session = _original_make_session
+
+
+def set_pool_size(pool_size: int) -> None:
+    """Change the connection pool size. Call it before making any requests: sessions that already exist keep theirs."""
+    global POOL_SIZE
+    POOL_SIZE = pool_size
+
+
+def _close_aiohttp_sessions() -> None:
+    for loop, session in list(_aiohttp_sessions.items()):
+        if not session.closed and loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+            except Exception:
+                pass
+
+
+atexit.register(_close_aiohttp_sessions)
@@ -1,4 +1,7 @@
-from typing import Union, List
+import contextlib
+import inspect
+from collections import OrderedDict
+from typing import Dict, Union, List, Optional, Tuple
 
 import torch
 import wandb
@@ -7,77 +10,333 @@ from wandb.sdk.wandb_run import Run
 from src.models.model import Model
 from src.models.common import load_hf_model_and_tokenizer
 
+# target positions per LM head call when scoring; each needs a (vocab size) row of logits
+LOGPROB_CHUNK_SIZE = 512
+# shared prompt prefixes (e.g. few-shot examples) shorter than this aren't worth encoding separately
+MIN_PREFIX_TOKENS = 16
+# prefixes whose past key values are kept
+PREFIX_CACHE_SIZE = 4
+# default budget of tokens per batch, counting padding
+MAX_BATCH_TOKENS = 8192
+# CPU inference modes, see `LlamaModel`
+CPU_MODES = ("fp32", "int8", "bf16")
 
 
+def pad_sequences(sequences: List[List[int]], pad_value: int) -> torch.Tensor:
+    """Right-pad lists of ints into a (batch, max_length) tensor."""
+    max_length = max(len(sequence) for sequence in sequences)
+    return torch.tensor([sequence + [pad_value] * (max_length - len(sequence)) for sequence in sequences])
+
+
+def plan_batches(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """Group sequences of similar length into batches that hold at most `max_batch_tokens` tokens once padded.
+
+    Sequences are taken longest first, so the first batch shows the peak memory use, and each batch is filled
+    while padding it to its first (longest) sequence stays within the budget. A sequence longer than the
+    budget gets a batch of its own. Returns lists of indices into `lengths`.
+    """
+    batches: List[List[int]] = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= max_batch_tokens:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
 
 class LlamaModel(Model):
-    def __init__(self, model_name_or_path: str, **kwargs) -> None:
-        self.model, self.tokenizer = load_hf_model_and_tokenizer(model_name_or_path)
+    """Local Hugging Face causal LM (Llama, Alpaca or Pythia).
+
+    `generate` and `cond_log_prob` take lists of any length: inputs are sorted by length and grouped into
+    batches of at most `max_batch_tokens` tokens including padding (see `plan_batches`), and the results come
+    back in input order. `batching_stats()` shows how much of the batches was padding.
+
+    For CPU-only machines, `cpu_mode` loads the model on the CPU as:
+    - "fp32": full precision weights and compute
+    - "int8": fp32 weights, with all linear layers (including the LM head) dynamically quantised to int8
+    - "bf16": bf16 weights, run under bf16 autocast (fast on CPUs with AVX-512 BF16 or AMX)
+    and `num_threads` sets the number of threads torch uses for intra-op parallelism (process-wide).
+    `scripts/benchmarks/bench_llama_cpu.py` compares their throughput and logprobs.
+    """
+
+    def __init__(
+        self,
+        model_name_or_path: str,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        cpu_mode: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        **kwargs,
+    ) -> None:
+        if cpu_mode is not None and cpu_mode not in CPU_MODES:
+            raise ValueError(f"cpu_mode must be one of {CPU_MODES}, got {cpu_mode}")
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        torch_dtype = {None: None, "fp32": torch.float32, "int8": torch.float32, "bf16": torch.bfloat16}[cpu_mode]
+        self.model, self.tokenizer = load_hf_model_and_tokenizer(model_name_or_path, torch_dtype=torch_dtype)
+        if cpu_mode is not None:
+            self.model.to("cpu")
+        if cpu_mode == "int8":
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.cpu_mode = cpu_mode
+        self.max_batch_tokens = max_batch_tokens
+        # older models (e.g. GPT-NeoX before transformers 4.30) infer positions from the cache length instead
+        self.takes_position_ids = "position_ids" in inspect.signature(self.model.forward).parameters
+        self.n_batches, self.n_tokens, self.n_padded_tokens, self.n_generated_tokens = 0, 0, 0, 0
+        # prefix token ids -> past key values for a batch of one, see `_shared_prefix`
+        self.prefix_cache: "OrderedDict[Tuple[int, ...], Tuple]" = OrderedDict()
 
     def generate(
         self,
         inputs: Union[str, List[str]],
         max_tokens: int,
+        stop_string: Optional[Union[str, List[str]]] = None,
+        temperature: float = 0,
+        do_sample: bool = False,
+        # not used, but needed for compatibility: only new tokens are decoded, without special tokens
         remove_padding: bool = True,
         **kwargs,
     ) -> List[str]:
+        """Generate up to `max_tokens` tokens after each input, and return only the generated text.
+
+        Like the OpenAI API, generation stops at EOS or at the first of the `stop_string`s, which is not included
+        in the output. Rows that have stopped are dropped from the batch (and the key/value cache), so a batch
+        only runs as long as its longest answer. Sampling is greedy unless `do_sample` and `temperature > 0`.
+        """
         if isinstance(inputs, str):
             inputs = [inputs]
+        stop_strings = [stop_string] if isinstance(stop_string, str) else list(stop_string or [])
 
-        input_tokens = self.tokenizer(inputs, padding=True, return_tensors="pt").input_ids.to(self.model.device)
-        output_tokens = self.model.generate(input_ids=input_tokens, max_new_tokens=max_tokens)
-        outputs = self.tokenizer.batch_decode(output_tokens)
-        if remove_padding:
-            outputs = [output.replace("<pad>", "") for output in outputs]
+        input_ids = self.tokenizer(list(inputs)).input_ids
+        outputs: List[str] = [""] * len(inputs)
+        for batch in self._plan_batches([len(ids) + max_tokens for ids in input_ids]):
+            new_tokens = self._generate_batch([input_ids[i] for i in batch], max_tokens, stop_strings, temperature if do_sample else 0)
+            self.n_generated_tokens += sum(len(tokens) for tokens in new_tokens)
+            for i, tokens in zip(batch, new_tokens):
+                outputs[i] = self._truncate_at_stop(self.tokenizer.decode(tokens, skip_special_tokens=True), stop_strings)
 
         return outputs
 
-    def _sum_target_logprobs(self, next_token_logprobs: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    def _generate_batch(self, input_ids: List[List[int]], max_tokens: int, stop_strings: List[str], temperature: float) -> List[List[int]]:
+        """Decode token by token with a key/value cache, dropping rows as they finish. Returns the new tokens."""
+        device = self.model.device
+        # left-padded by the tokenizer, so every prompt's last token is in the last column
+        encoded = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(device)
+        next_input_ids, attention_mask = encoded.input_ids, encoded.attention_mask
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        # a stop string spans at most one token per character; one more token keeps decoding from trimming its start
+        stop_window = max((len(stop) for stop in stop_strings), default=0) + 1
+
+        new_tokens: List[List[int]] = [[] for _ in input_ids]
+        active = list(range(len(input_ids)))
+        past_key_values = None
+        with torch.no_grad(), self._autocast():
+            for _ in range(max_tokens):
+                position_kwargs = {"position_ids": position_ids} if self.takes_position_ids else {}
+                model_outputs = self.model(
+                    next_input_ids, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True, **position_kwargs
+                )
+                logits = model_outputs.logits[:, -1].float()
+                if temperature > 0:
+                    next_tokens = torch.multinomial(torch.softmax(logits / temperature, dim=-1), num_samples=1).squeeze(-1)
+                else:
+                    next_tokens = logits.argmax(dim=-1)
+
+                keep = []
+                for row, (i, token) in enumerate(zip(active, next_tokens.tolist())):
+                    new_tokens[i].append(token)
+                    stopped = token == self.tokenizer.eos_token_id or (
+                        stop_strings and any(stop in self.tokenizer.decode(new_tokens[i][-stop_window:]) for stop in stop_strings)
+                    )
+                    if not stopped:
+                        keep.append(row)
+                if not keep:
+                    break
+
+                past_key_values = model_outputs.past_key_values
+                if len(keep) < len(active):
+                    rows = torch.tensor(keep, device=device)
+                    active = [active[row] for row in keep]
+                    next_tokens, attention_mask, position_ids = next_tokens[rows], attention_mask[rows], position_ids[rows]
+                    past_key_values = tuple(tuple(state[rows] for state in layer) for layer in past_key_values)
+                next_input_ids = next_tokens[:, None]
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones(len(active), 1)], dim=-1)
+                position_ids = position_ids[:, -1:] + 1
+
+        return new_tokens
+
+    @staticmethod
+    def _truncate_at_stop(text: str, stop_strings: List[str]) -> str:
+        stop_idx = [text.find(stop) for stop in stop_strings if stop in text]
+        return text[: min(stop_idx)] if stop_idx else text
+
+    def _autocast(self):
+        if self.cpu_mode == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _plan_batches(self, lengths: List[int]) -> List[List[int]]:
+        batches = plan_batches(lengths, self.max_batch_tokens)
+        self.n_batches += len(batches)
+        self.n_tokens += sum(lengths)
+        self.n_padded_tokens += sum(len(batch) * lengths[batch[0]] for batch in batches)
+        return batches
+
+    def batching_stats(self) -> Dict[str, float]:
+        """Batches run so far, the fraction of their tokens that were padding, and the tokens `generate` produced."""
+        return {
+            "batches": self.n_batches,
+            "tokens": self.n_tokens,
+            "padded_tokens": self.n_padded_tokens,
+            "padding_ratio": 1 - self.n_tokens / self.n_padded_tokens if self.n_padded_tokens else 0.0,
+            "generated_tokens": self.n_generated_tokens,
+        }
+
+    def _tokenize_examples(self, inputs: List[str], targets: List[str]) -> Tuple[List[List[int]], List[List[int]], List[int]]:
+        """Tokenise each input + target, with what's needed to tell the target tokens apart.
+
+        Returns token ids, a position per token and a boundary per example, such that the target tokens are the
+        ones positioned past the boundary. With a fast tokenizer, positions are the character offsets where the
+        tokens end, and the boundary is the input's length in characters. Slow tokenizers have no offsets, so the
+        inputs are tokenised on their own: positions are token indices and the boundary is the input's last token.
+        """
+        is_fast = self.tokenizer.is_fast
+        encoded = self.tokenizer([inp + target for inp, target in zip(inputs, targets)], return_offsets_mapping=is_fast)
+        if is_fast:
+            # special tokens have offsets (0, 0), so they never end past the input
+            token_positions = [[end for _, end in offsets] for offsets in encoded.offset_mapping]
+            boundaries = [len(inp) for inp in inputs]
+        else:
+            token_positions = [list(range(len(ids))) for ids in encoded.input_ids]
+            boundaries = [len(ids) - 1 for ids in self.tokenizer(list(inputs)).input_ids]
+        return encoded.input_ids, token_positions, boundaries
+
+    def _encode_examples(
+        self, input_ids: List[List[int]], token_positions: List[List[int]], boundaries: List[int]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Right-pad a batch of tokenised examples, and mark their target tokens in one comparison.
+
+        Padding goes on the right, after the scored tokens, so it doesn't shift their positions.
+
+        Returns input ids, attention mask and target mask, all (batch, seq).
         """
-        Extracts the log probabilities of the targets from the log probabilities of the model by masking out all but the
-        logits corresponding to the targets.
+        padded_ids = pad_sequences(input_ids, self.tokenizer.pad_token_id)
+        attention_mask = torch.arange(padded_ids.shape[1]) < torch.tensor([len(ids) for ids in input_ids])[:, None]
+        target_mask = pad_sequences(token_positions, 0) > torch.tensor(boundaries)[:, None]
+        return padded_ids, attention_mask.long(), target_mask & attention_mask
+
+    def _shared_prefix(self, input_ids: torch.Tensor, max_length: int, prefix: Optional[str] = None) -> Tuple[int, Optional[Tuple]]:
+        """Find tokens that start every example and can be encoded once for the whole batch.
+
+        The prefix is at most `max_length` tokens and comes from, in order of preference: the `prefix` text, the
+        longest prefix already in `prefix_cache`, or the batch's longest common prefix (if the batch has more than
+        one example and the prefix has at least MIN_PREFIX_TOKENS tokens). Its past key values are cached, so
+        later batches starting with the same few-shot prompt don't encode it again.
 
-        :param next_token_logprobs (batch_size, seq): The log probabilities of the model for the next token at each position.
+        Returns the prefix length and its past key values for a batch of one, or (0, None).
         """
-        mask = torch.zeros(next_token_logprobs.shape, device=next_token_logprobs.device)
-        # left-shift is because probabilities are shifted one to the left
-        mask[:, -targets.shape[1]-1:-1] = (targets != self.tokenizer.pad_token_id)
-        
-        logprobs_masked = next_token_logprobs * mask
+        same = (input_ids == input_ids[:1]).all(dim=0)
+        common_length = min(int(same.int().cumprod(dim=0).sum()), max_length)
+        common_ids = input_ids[0, :common_length].tolist()
 
-        return logprobs_masked.sum(dim=-1)
+        if prefix is not None:
+            length = min(len(self.tokenizer(prefix).input_ids), common_length)
+        else:
+            cached = [len(ids) for ids in self.prefix_cache if len(ids) <= common_length and tuple(common_ids[: len(ids)]) == ids]
+            if cached:
+                length = max(cached)
+            elif len(input_ids) > 1 and common_length >= MIN_PREFIX_TOKENS:
+                length = common_length
+            else:
+                length = 0
+        if length <= 0:
+            return 0, None
 
+        key = tuple(common_ids[:length])
+        if key not in self.prefix_cache:
+            self.prefix_cache[key] = self.model.base_model(input_ids[:1, :length], use_cache=True).past_key_values
+            while len(self.prefix_cache) > PREFIX_CACHE_SIZE:
+                self.prefix_cache.popitem(last=False)
+        self.prefix_cache.move_to_end(key)
+        return length, self.prefix_cache[key]
 
-    def _cond_log_prob(self, inputs: Union[str, List[str]], targets: Union[str, List[str]], **kwargs) -> List[List[float]]:
+    def _cond_log_prob(
+        self, inputs: Union[str, List[str]], targets: Union[str, List[str]], prefix: Optional[str] = None, **kwargs
+    ) -> torch.Tensor:
         if isinstance(inputs, str):
             inputs = [inputs]
         if isinstance(targets, str):
             targets = [targets]
 
-        examples_tokenized = self.tokenizer([inp + target for inp, target in zip(inputs, targets)], padding=True, return_tensors="pt")
-        examples_tokens = examples_tokenized.input_ids.to(self.model.device)
-        examples_attention_mask = examples_tokenized.attention_mask.to(self.model.device)
-
-        with torch.no_grad():
-            logits = self.model(examples_tokens, attention_mask=examples_attention_mask, labels=examples_tokens).logits
-            logprobs = torch.nn.functional.log_softmax(logits, dim=-1)
-            next_token_logprobs = torch.gather(logprobs[:, :-1], dim=-1, index=examples_tokens[:, 1:].unsqueeze(-1)).squeeze(-1)
-
-        # mask out the tokens that don't contain the target
-        target_tokens_mask = torch.zeros_like(next_token_logprobs, dtype=torch.int)
-        for i, (example_tokens, inp) in enumerate(zip(examples_tokens, inputs)):
-            # find the smallest j such that 
-            j = 1
-            while len(self.tokenizer.decode(example_tokens[:j])) <= len(inp):
-                j += 1
-            # left shift by one because predictions will be one to the left
-            target_tokens_mask[i, j-1:-1] = 1
-        relevant_logprobs = next_token_logprobs * target_tokens_mask
-
-        return relevant_logprobs.sum(dim=-1)
-
-    def cond_log_prob(self, inputs: Union[str, List[str]], targets, **kwargs) -> List[List[float]]:
-        return self._cond_log_prob(inputs, targets, **kwargs)
+        input_ids, token_positions, boundaries = self._tokenize_examples(inputs, targets)
+        scores = torch.zeros(len(input_ids), device=self.model.device)
+        for batch in self._plan_batches([len(ids) for ids in input_ids]):
+            encoded = self._encode_examples(
+                [input_ids[i] for i in batch], [token_positions[i] for i in batch], [boundaries[i] for i in batch]
+            )
+            scores[torch.tensor(batch, device=scores.device)] = self._score_batch(*encoded, prefix=prefix)
+
+        return scores
+
+    def _score_batch(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, target_mask: torch.Tensor, prefix: Optional[str] = None
+    ) -> torch.Tensor:
+        device = self.model.device
+        input_ids, attention_mask, target_mask = input_ids.to(device), attention_mask.to(device), target_mask.to(device)
+        # the position before an example's first target token predicts it, so the prefix must stop before that
+        lengths = attention_mask.sum(dim=-1)
+        first_target = torch.where(target_mask.any(dim=-1), target_mask.int().argmax(dim=-1), lengths)
+        max_prefix_length = int(first_target.min()) - 1
+
+        with torch.no_grad(), self._autocast():
+            prefix_length, prefix_past_key_values = self._shared_prefix(input_ids, max_prefix_length, prefix)
+            past_key_values = None
+            if prefix_past_key_values is not None:
+                batch_size = len(input_ids)
+                past_key_values = tuple(
+                    tuple(state.expand(batch_size, *state.shape[1:]) for state in layer) for layer in prefix_past_key_values
+                )
+            # examples are right-padded, so the attention mask is all ones over the prefix
+            hidden_states = self.model.base_model(
+                input_ids[:, prefix_length:], attention_mask=attention_mask, past_key_values=past_key_values
+            ).last_hidden_state
+            return self._sum_target_logprobs(hidden_states, input_ids[:, prefix_length:], target_mask[:, prefix_length:])
+
+    def _sum_target_logprobs(
+        self, hidden_states: torch.Tensor, input_ids: torch.Tensor, target_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """Sum the logprobs of each example's target tokens, applying the LM head only where they are predicted.
+
+        Instead of (batch, seq, vocab) logits, only (LOGPROB_CHUNK_SIZE, vocab) of them exist at a time: the
+        hidden states at the target positions are flattened and sent through the LM head and a float32
+        logsumexp in chunks, and the results are added up per example.
+
+        :param hidden_states (batch, seq, hidden): final hidden states of the model, after the last layer norm.
+        :param target_mask (batch, seq): True at the target tokens.
+        """
+        # token j is predicted at position j - 1
+        predicting = target_mask[:, 1:]
+        rows = predicting.nonzero(as_tuple=True)[0]
+        target_hidden_states = hidden_states[:, :-1][predicting]
+        target_ids = input_ids[:, 1:][predicting]
+
+        lm_head = self.model.get_output_embeddings()
+        sums = torch.zeros(input_ids.shape[0], dtype=torch.float32, device=hidden_states.device)
+        for start in range(0, len(target_ids), LOGPROB_CHUNK_SIZE):
+            end = start + LOGPROB_CHUNK_SIZE
+            logits = lm_head(target_hidden_states[start:end]).float()
+            logprobs = logits.gather(-1, target_ids[start:end, None]).squeeze(-1) - logits.logsumexp(dim=-1)
+            sums.index_add_(0, rows[start:end], logprobs)
+
+        return sums
+
+    def cond_log_prob(self, inputs: Union[str, List[str]], targets, prefix: Optional[str] = None, **kwargs) -> List[List[float]]:
+        """Sum of the target tokens' logprobs for each (input, target) pair, as a tensor.
+
+        Tokens shared by the start of all inputs, e.g. a few-shot prompt, are encoded once and their past key values
+        reused across the batch and across calls. Pass the shared text as `prefix`, or leave it to be detected.
+        """
+        return self._cond_log_prob(inputs, targets, prefix=prefix, **kwargs)
 
     def get_wandb_runs(self, wandb_entity: str, wandb_project: str) -> List[Run]:
         api = wandb.Api()
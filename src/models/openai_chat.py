@@ -1,24 +1,30 @@
 import argparse
-import concurrent.futures
+import asyncio
 import logging
 import math
 import os
 import re
 import sys
-import time
 from dataclasses import dataclass
-from typing import Callable, List
+from typing import Callable, List, Set
 
 import diskcache as dc
 import dotenv
 import openai
 from scipy.stats import binom
-from tenacity import retry
-from tenacity.stop import stop_after_attempt
 
 from src.common import attach_debugger
-from src.models.openai_complete import get_cost_per_1k_tokens, log_after_retry
-from src.models.throttling import RateLimiter, wait_random_exponential
+from src.models.caching import SamplePoolCache, hash_request
+from src.models.concurrency import ABANDONED, SingleFlight, run_sync
+from src.models.openai_complete import (
+    acomplete_with_backoff,
+    get_concurrency_controller,
+    get_cost_per_1k_tokens,
+    rate_limiter,
+)
+from src.models.request_journal import get_journal
+from src.models.token_counting import count_message_tokens
+from src.models.usage import get_usage_tracker
 
 dotenv.load_dotenv()
 
@@ -28,28 +34,98 @@ logger = logging.getLogger(__name__)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 CACHE_DIR = os.path.join("cache", "chat_cache")
+# the API rejects larger `n`
+MAX_N_PER_REQUEST = 128
 
-rate_limiter = RateLimiter()
 cache = dc.Cache(CACHE_DIR, size_limit=10 * 1e9)
+# samples drawn at temperature > 0, replayed by `OpenAIChatAPI.sample_many`
+sample_pool = SamplePoolCache(os.path.join("cache", "sample_pool"))
+# shares in-flight temperature 0 requests between concurrent callers
+inflight = SingleFlight()
+# models that rejected the `n` parameter, which are sampled with one request per sample instead
+models_without_n: Set[str] = set()
+
+
+def estimate_request_tokens(kwargs) -> int:
+    """Tokens a chat request counts against the rate limit: its messages, plus `max_tokens` per choice if set."""
+    n_tokens = count_message_tokens(kwargs["messages"], kwargs["model"])
+    if kwargs.get("max_tokens") is not None:
+        n_tokens += kwargs["max_tokens"] * kwargs.get("n", 1)
+    return n_tokens
+
+
+async def aestimate_request_tokens(kwargs) -> int:
+    """`estimate_request_tokens` on a worker thread: the first count for a model loads its encoding, which can take
+    a while (and download it), and would otherwise stall every request on the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, estimate_request_tokens, kwargs)
+
+
+async def acreate_throttled(hedge_percentile=None, **kwargs):
+    """`openai.ChatCompletion.acreate` the way `acached_complete` sends completions: admitted by the rate limiter
+    (shared with the completion client), then sent with `acomplete_with_backoff` (AIMD concurrency window, retries
+    and optional hedging).
+
+    The request is admitted before it takes a slot in the window, so waiting on the rate limit doesn't hold one.
+    Admission is on an estimate of the request's tokens, made once and outside the retries (an error in making it
+    is a bug on our side, which retrying won't fix), and reconciled with the reported usage afterwards.
+    """
+    model_name = kwargs["model"]
+    n_tokens = await aestimate_request_tokens(kwargs)
+    await rate_limiter.athrottle(n_tokens, model_name)
+    response = await acomplete_with_backoff(
+        openai.ChatCompletion.acreate,
+        hedge_percentile=hedge_percentile,
+        before_hedge=lambda: rate_limiter.athrottle(n_tokens, model_name),
+        **kwargs,
+    )
+    await rate_limiter.areconcile(n_tokens, response.usage.total_tokens, model_name)  # type: ignore
+    get_usage_tracker().record_response(model_name, response, get_cost_per_1k_tokens(model_name))
+    return response
 
 
 @cache.memoize()
 def complete_memoized(*args, **kwargs):
+    # only used for its cache keys, which `acomplete_conditional_memoize_with_retrying` shares
     return openai.ChatCompletion.create(*args, **kwargs)
 
 
-@retry(
-    wait=wait_random_exponential(min=3, max=60),
-    stop=stop_after_attempt(6),
-    after=log_after_retry(logger, logging.INFO),
-)
-def complete_conditional_memoize_with_retrying(nocache=False, *args, **kwargs):
+def complete_conditional_memoize_with_retrying(nocache=False, hedge_percentile=None, **kwargs):
+    """Synchronous version of `acomplete_conditional_memoize_with_retrying`, run on the shared event loop
+    so that requests from threads go through the same concurrency window as everything else."""
+    return run_sync(acomplete_conditional_memoize_with_retrying(nocache=nocache, hedge_percentile=hedge_percentile, **kwargs))
+
+
+async def acomplete_conditional_memoize_with_retrying(nocache=False, hedge_percentile=None, **kwargs):
+    """Send a chat request with `acreate_throttled`, through the persistent cache at temperature 0."""
     temperature = kwargs.get("temperature", None)
     should_cache = temperature == 0 and not nocache
-    if should_cache:
-        return complete_memoized(**kwargs)
-    else:
-        return openai.ChatCompletion.create(*args, **kwargs)
+    if not should_cache:
+        return await acreate_throttled(hedge_percentile=hedge_percentile, **kwargs)
+
+    cache_key = complete_memoized.__cache_key__(**kwargs)
+    future, leader = inflight.claim(hash_request(kwargs))
+    if not leader:
+        response = await asyncio.wrap_future(future)
+        if response is ABANDONED:
+            return await acomplete_conditional_memoize_with_retrying(nocache, hedge_percentile, **kwargs)
+        return response
+    # cache lookups and writes are SQLite transactions, so like the rate limiter's they run on a worker thread
+    loop = asyncio.get_running_loop()
+    try:
+        response = await loop.run_in_executor(None, cache.get, cache_key)
+        if response is None:
+            response = await acreate_throttled(hedge_percentile=hedge_percentile, **kwargs)
+            await loop.run_in_executor(None, cache.set, cache_key, response)
+        else:
+            get_usage_tracker().record_cache_hits(kwargs["model"], 1)
+    except Exception as e:
+        inflight.resolve(hash_request(kwargs), exception=e)
+        raise
+    except BaseException:
+        inflight.abandon(hash_request(kwargs))
+        raise
+    inflight.resolve(hash_request(kwargs), response)
+    return response
 
 
 @dataclass
@@ -62,10 +138,12 @@ class ChatMessage:
 
 
 class OpenAIChatAPI:
-    def __init__(self, model="gpt-3.5-turbo", log_requests=True):
+    def __init__(self, model="gpt-3.5-turbo", log_requests=True, hedge_percentile=None):
         self.queries = []
         self.model = model
         self.log_requests = log_requests
+        # see `OpenAIAPI`
+        self.hedge_percentile = hedge_percentile
         os.makedirs(CACHE_DIR, exist_ok=True)
 
     def generate(
@@ -85,6 +163,122 @@ class OpenAIChatAPI:
 
         return response.choices[0].message.content  # type: ignore
 
+    def generate_many(
+        self,
+        messages_list: List[List[ChatMessage]],
+        temperature: float = 0.0,
+        nocache=False,
+        **kwargs,
+    ) -> List[str]:
+        """Generate a response for each conversation in `messages_list`, returned in the same order.
+
+        As many requests are in flight at once as the model's AIMD concurrency window allows, all going through
+        the persistent cache (for temperature 0), the shared rate limiter and the request journal.
+        """
+        return run_sync(self.agenerate_many(messages_list, temperature=temperature, nocache=nocache, **kwargs))
+
+    async def agenerate_many(
+        self,
+        messages_list: List[List[ChatMessage]],
+        temperature: float = 0.0,
+        nocache=False,
+        **kwargs,
+    ) -> List[str]:
+        async def generate_one(messages):
+            response = await self._acomplete(
+                messages=[message.to_dict() for message in messages],
+                temperature=temperature,
+                nocache=nocache,
+                **kwargs,
+            )
+            return response.choices[0].message.content  # type: ignore
+
+        return await asyncio.gather(*[generate_one(messages) for messages in messages_list])
+
+    def sample_many(
+        self,
+        messages_list: List[List[ChatMessage]],
+        n: int,
+        temperature: float = 1.0,
+        nocache=False,
+        **kwargs,
+    ) -> List[List[str]]:
+        """Sample `n` responses to each conversation in `messages_list`.
+
+        Each conversation is sent once with the `n` parameter (split into requests of at most `MAX_N_PER_REQUEST`
+        choices), so its prompt tokens are paid for once rather than `n` times. Models that reject `n` fall back
+        to `n` separate requests.
+
+        At temperature > 0 the samples come from the persistent `sample_pool`: the first `n` samples stored for
+        the same model, messages and sampling parameters are reused, and only the missing ones are requested.
+        Pass `nocache=True` for fresh samples.
+        """
+        return run_sync(self.asample_many(messages_list, n, temperature=temperature, nocache=nocache, **kwargs))
+
+    async def asample_many(
+        self,
+        messages_list: List[List[ChatMessage]],
+        n: int,
+        temperature: float = 1.0,
+        nocache=False,
+        **kwargs,
+    ) -> List[List[str]]:
+        async def sample_chunk(messages, n_chunk):
+            n_kwargs = {"n": n_chunk} if n_chunk > 1 else {}
+            response = await self._acomplete(
+                messages=[message.to_dict() for message in messages],
+                temperature=temperature,
+                nocache=nocache,
+                **n_kwargs,
+                **kwargs,
+            )
+            return [choice.message.content for choice in response.choices]  # type: ignore
+
+        async def fetch(messages, n_samples):
+            max_n = 1 if self.model in models_without_n else MAX_N_PER_REQUEST
+            chunk_sizes = [min(max_n, n_samples - start) for start in range(0, n_samples, max_n)]
+            tasks = [asyncio.ensure_future(sample_chunk(messages, n_chunk)) for n_chunk in chunk_sizes]
+            try:
+                chunks = await asyncio.gather(*tasks)
+            except openai.error.InvalidRequestError as e:
+                if e.param != "n" or max_n == 1:
+                    raise
+                # the other chunks would be rejected too, or answered and thrown away: stop them before falling back
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+                logger.warning(f"{self.model} doesn't support the n parameter, sending one request per sample instead")
+                models_without_n.add(self.model)
+                return await fetch(messages, n_samples)
+            finally:
+                # e.g. after another error, or if we were cancelled ourselves
+                for task in tasks:
+                    task.cancel()
+            return [content for chunk in chunks for content in chunk]
+
+        async def sample(messages):
+            if temperature == 0 or nocache:
+                return await fetch(messages, n)
+
+            pool_key = sample_pool.make_key(
+                {
+                    "model": self.model,
+                    "messages": [message.to_dict() for message in messages],
+                    "temperature": temperature,
+                    **kwargs,
+                }
+            )
+            # on a worker thread, like the completion cache
+            loop = asyncio.get_running_loop()
+            samples = await loop.run_in_executor(None, sample_pool.get, pool_key, n)
+            get_usage_tracker().record_cache_hits(self.model, len(samples))
+            if len(samples) < n:
+                new_samples = await fetch(messages, n - len(samples))
+                samples = (await loop.run_in_executor(None, sample_pool.extend, pool_key, new_samples))[:n]
+            return samples
+
+        return await asyncio.gather(*[sample(messages) for messages in messages_list])
+
     def _complete(self, **kwargs):
         """Request OpenAI API ChatCompletion with:
         - request throttling
@@ -95,127 +289,99 @@ class OpenAIChatAPI:
         model_name = self.model
         kwargs["model"] = model_name
         nocache = kwargs.pop("nocache", False)
-        response = complete_conditional_memoize_with_retrying(nocache=nocache, **kwargs)
+        response = complete_conditional_memoize_with_retrying(
+            nocache=nocache, hedge_percentile=self.hedge_percentile, **kwargs
+        )
+        self._log_response(kwargs, response)
+        return response
+
+    async def _acomplete(self, **kwargs):
+        """Request OpenAI API ChatCompletion with:
+        - request throttling
+        - persistent caching
+        """
+
+        model_name = self.model
+        kwargs["model"] = model_name
+        nocache = kwargs.pop("nocache", False)
+        response = await acomplete_conditional_memoize_with_retrying(
+            nocache=nocache, hedge_percentile=self.hedge_percentile, **kwargs
+        )
+        self._log_response(kwargs, response)
+        return response
 
-        # log request
+    def _log_response(self, kwargs, response):
+        model_name = self.model
         n_tokens_sent = response.usage.prompt_tokens  # type: ignore
         n_tokens_received = response.usage.completion_tokens  # type: ignore
         n_tokens_total = n_tokens_sent + n_tokens_received
         cost = (n_tokens_total / 1000) * get_cost_per_1k_tokens(model_name)
-        timestamp_str = time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime()) + f".{int(time.time() * 1000) % 1000:03d}"
         if self.log_requests:
             self.log_request(
                 kwargs,
                 response,
-                timestamp_str,
                 model_name,
                 n_tokens_sent,
                 n_tokens_received,
                 cost,
             )
-        return response
 
     def log_request(
         self,
         kwargs,
         response,
-        timestamp_str,
         model_name,
         n_tokens_sent,
         n_tokens_received,
         cost,
     ):
-        with open(os.path.join(CACHE_DIR, f"{timestamp_str}-{model_name}.txt"), "a") as f:
-            f.write("<REQUEST METADATA AFTER NEWLINE>\n")
-            f.write(
-                f"Chat request @ {timestamp_str}. Tokens sent: {n_tokens_sent}. Tokens received: {n_tokens_received}. Cost: ${cost:.4f}\n"
-            )
-            for i, choice in enumerate(response.choices):
-                f.write(f"\n<PROMPT AFTER NEWLINE>\n")
-                messages = kwargs["messages"]
-                prompt = "\n".join([f'{m["role"]}: {m["content"]}' for m in messages])
-                completion = choice.message.content
-                f.write(prompt)
-                f.write("<COMPLETION_START>" + completion)
-                f.write("<COMPLETION_END>\n\n")
+        prompt = "\n".join([f'{m["role"]}: {m["content"]}' for m in kwargs["messages"]])
+        get_journal().log(
+            {
+                "client": "chat",
+                "model": model_name,
+                "n_prompts": 1,
+                "n_tokens_sent": n_tokens_sent,
+                "n_tokens_received": n_tokens_received,
+                "cost": cost,
+                "concurrency_window": get_concurrency_controller(model_name).window,
+                "prompts": [prompt],
+                "completions": [choice.message.content for choice in response.choices],
+            }
+        )
+
+
+def split_lines(content: str) -> list[str]:
+    """Default `parse` of the batch helpers: a response's stripped, non-empty lines, each scored as an answer."""
+    return [line.strip() for line in content.strip().split("\n") if line]
 
 
 def chat_batch_generate(
     message: str,
     n_threads: int,
-    parse: Callable = lambda content: [line.strip() for line in content.strip().split("\n") if line],
+    parse: Callable = split_lines,
     model: str = "gpt-3.5-turbo",
     system_message: str = "You are a helpful assistant.",
 ):
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-    @retry(
-        wait=wait_random_exponential(min=3, max=60),
-        stop=stop_after_attempt(6),
-        after=log_after_retry(logger, logging.INFO),
-    )
-    def retry_with_exp_backoff(func, *args, **kwargs):
-        return func(*args, **kwargs)
-
-    answers = []
-
-    def api_call(_):
-        response = retry_with_exp_backoff(
-            openai.ChatCompletion.create,  # type: ignore
-            model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": message},
-            ],
-        )
-
-        content = response.choices[0].message.content  # type: ignore
-        return parse(content)
-
-    # Call the API `n_threads` times
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(api_call, range(n_threads))
-
-    for result in results:
-        answers.extend(result)
-
-    return answers
+    messages = [ChatMessage("system", system_message), ChatMessage("user", message)]
+    return chat_batch_generate_multiple_messages(messages, n_threads, parse=parse, model=model)
 
 
 def chat_batch_generate_multiple_messages(
     messages: list[ChatMessage],
     n_threads: int,
-    parse: Callable = lambda content: [line.strip() for line in content.strip().split("\n") if line],
+    parse: Callable = split_lines,
     model: str = "gpt-3.5-turbo",
 ) -> list:
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-    logger = logging.getLogger(__name__)
+    """Sample `n_threads` responses to `messages`, returning all of their parsed lines.
 
-    @retry(
-        wait=wait_random_exponential(min=3, max=60),
-        stop=stop_after_attempt(6),
-        after=log_after_retry(logger, logging.INFO),
-    )
-    def retry_with_exp_backoff(func, *args, **kwargs):
-        return func(*args, **kwargs)
+    The samples come from `OpenAIChatAPI.sample_many`, i.e. as few requests as the `n` parameter allows.
+    """
+    responses = OpenAIChatAPI(model=model).sample_many([messages], n_threads)[0]
 
     answers = []
-
-    def api_call(_):
-        response = retry_with_exp_backoff(
-            openai.ChatCompletion.create, model=model, messages=[message.to_dict() for message in messages]  # type: ignore
-        )
-
-        content = response.choices[0].message.content  # type: ignore
-        return parse(content)
-
-    # Call the API `n_threads` times
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(api_call, range(n_threads))
-
-    for result in results:
-        answers.extend(result)
+    for content in responses:
+        answers.extend(parse(content))
 
     return answers
 
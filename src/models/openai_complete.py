@@ -1,24 +1,28 @@
+import asyncio
+import concurrent.futures
 import openai
-import scipy
 import numpy as np
 import os
-import time
 import dotenv
 import tiktoken
-import time
 import logging
 import sys
-import diskcache as dc
 
 from dataclasses import dataclass
-from typing import List, Tuple, Union
+from typing import Any, Coroutine, Iterator, List, Tuple, Union
 
 import wandb
 from wandb.sdk.wandb_run import Run
+from src.models.caching import CompletionCache
+from src.models.concurrency import ABANDONED, AIMDController, SingleFlight, get_aimd_controller, get_hedger, run_sync, submit
+from src.models.http_pool import install as install_http_pool, use_pooled_aiohttp_session
 from src.models.model import Model
+from src.models.request_journal import get_journal
 from src.models.throttling import RateLimiter, wait_random_exponential
+from src.models.token_counting import get_token_counter
+from src.models.usage import get_usage_tracker
 
-from tenacity import retry
+from tenacity import retry, retry_if_exception_type, retry_if_not_exception_type
 from tenacity.stop import stop_after_attempt
 
 dotenv.load_dotenv()
@@ -28,13 +32,24 @@ logger = logging.getLogger(__name__)
 
 openai.organization = os.getenv("OPENAI_ORGANIZATION", None)
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# share keep-alive connections between all threads and requests
+install_http_pool()
 
 CACHE_DIR = "cache"
 
 rate_limiter = RateLimiter()
+# shares in-flight temperature 0 prompts between concurrent batches
+inflight = SingleFlight()
+# errors that mean we're sending too much, which shrink the model's concurrency window
+OVERLOAD_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError)
+
+
+def get_concurrency_controller(model_name) -> AIMDController:
+    """The model's AIMD concurrency window, shared by the completion and chat clients."""
+    return get_aimd_controller(model_name, overload_errors=OVERLOAD_ERRORS)
 
 try:
-    cache = dc.Cache(os.path.join(CACHE_DIR, "completion_cache"), size_limit=10 * 1e9)
+    cache = CompletionCache(os.path.join(CACHE_DIR, "completion_cache"), size_limit=10 * 1e9)
 except Exception as e:
     print("Could not create cache " + str(e))
 
@@ -87,6 +102,11 @@ def get_cost_per_1k_tokens(model_name, training=False):
         return base_inference_price_dict.get(model_name, 0)
 
 
+# malformed requests fail the same way every time, and a cancelled request (e.g. from a closed stream) was
+# cancelled on purpose: tenacity would otherwise retry any BaseException, including asyncio.CancelledError
+retry_api_errors = retry_if_exception_type(Exception) & retry_if_not_exception_type(openai.error.InvalidRequestError)
+
+
 def log_after_retry(logger, level):
     def log(retry_state):
         logger.log(
@@ -101,6 +121,7 @@ def log_after_retry(logger, level):
 
 
 @retry(
+    retry=retry_api_errors,
     wait=wait_random_exponential(min=3, max=60),
     stop=stop_after_attempt(6),
     after=log_after_retry(logger, logging.INFO),
@@ -109,58 +130,155 @@ def complete_with_backoff(func, **kwargs):
     return func(**kwargs)
 
 
-def cached_complete(request_sizes, **kwargs):
+@retry(
+    retry=retry_api_errors,
+    wait=wait_random_exponential(min=3, max=60),
+    stop=stop_after_attempt(6),
+    after=log_after_retry(logger, logging.INFO),
+)
+async def acomplete_with_backoff(func, hedge_percentile=None, before_hedge=None, **kwargs):
+    """Each attempt waits for a slot in the model's AIMD concurrency window.
+
+    With `hedge_percentile`, an attempt slower than that percentile of the model's recent latencies is duplicated
+    and the first response wins (see `Hedger`). Latencies are timed from when the attempt holds its slot, so
+    an attempt still queued for one is never hedged. The duplicate waits for its own slot, after awaiting
+    `before_hedge()` for rate limiter admission if `func` doesn't throttle itself.
+    """
+    model_name = kwargs.get("engine", None) or kwargs.get("model", None)
+    controller = get_concurrency_controller(model_name)
+
+    async def send():
+        use_pooled_aiohttp_session()
+        return await func(**kwargs)
+
+    async def hedge():
+        async with controller.slot():
+            return await send()
+
+    async with controller.slot():
+        return await get_hedger(model_name).run(send, hedge_percentile, before_hedge, make_hedge=hedge)
+
+
+async def acached_complete(request_sizes, hedge_percentile=None, **kwargs):
+    """Complete a batch of prompts, answering temperature 0 prompts from the cache where possible.
+
+    API responses are counted by the usage tracker, and so are prompts answered from the cache or by a concurrent batch.
+    """
     model_name = kwargs.get("engine", None) or kwargs.get("model", None)
-    should_cache = kwargs.get("temperature", 0) == 0
+    usage_tracker = get_usage_tracker()
+    # with n > 1 there is more than one choice per prompt, which the per-prompt cache can't represent
+    should_cache = kwargs.get("temperature", 0) == 0 and kwargs.get("n", 1) == 1
 
     if should_cache:
         kwargs_copy = kwargs.copy()
         inputs = kwargs_copy.pop("prompt")
-        cache_base_keys = list(kwargs_copy.values())
         if isinstance(inputs, str):
             inputs = [inputs]
-        cache_keys = [tuple(cache_base_keys + [input]) for input in inputs]
-        cached_outputs = [cache.get(cache_key) for cache_key in cache_keys]
-        # check if all None
-        hit_list = [output is not None for output in cached_outputs]
-        if all(hit_list):
+        cache_keys = cache.make_keys(kwargs_copy, inputs)
+
+        # only request prompts that no concurrent batch is already requesting, wait for the others
+        claims = [inflight.claim(cache_key) for cache_key in cache_keys]
+        led_idx = [i for i, (_, leader) in enumerate(claims) if leader]
+        outputs = [None] * len(inputs)
+        batch_outputs = None
+        # cache lookups and writes are SQLite transactions, so like the rate limiter's they run on a worker thread
+        loop = asyncio.get_running_loop()
+        try:
+            cached_outputs = await loop.run_in_executor(None, cache.get_many, [cache_keys[i] for i in led_idx])
+            for i, output in zip(led_idx, cached_outputs):
+                outputs[i] = output
+            missing_idx = [i for i in led_idx if outputs[i] is None]
+            if missing_idx:
+                n_tokens = sum(request_sizes[i] for i in missing_idx)
+                await rate_limiter.athrottle(n_tokens, model_name)
+                kwargs_copy["prompt"] = [inputs[i] for i in missing_idx]
+                batch_outputs = await acomplete_with_backoff(
+                    openai.Completion.acreate,
+                    hedge_percentile=hedge_percentile,
+                    before_hedge=lambda: rate_limiter.athrottle(n_tokens, model_name),
+                    **kwargs_copy,
+                )
+                usage_tracker.record_response(model_name, batch_outputs, get_cost_per_1k_tokens(model_name))
+                new_choices = sorted(batch_outputs.choices, key=lambda x: x.index)  # type: ignore
+                for i, choice in zip(missing_idx, new_choices):
+                    outputs[i] = choice
+
+                # cache outputs
+                await loop.run_in_executor(
+                    None, cache.set_many, [(cache_keys[i], choice) for i, choice in zip(missing_idx, new_choices)]
+                )
+        except Exception as e:
+            for i in led_idx:
+                inflight.resolve(cache_keys[i], exception=e)
+            raise
+        except BaseException:
+            # cancelled (e.g. a closed stream): batches waiting on these prompts request them themselves
+            for i in led_idx:
+                inflight.abandon(cache_keys[i])
+            raise
+
+        for i in led_idx:
+            inflight.resolve(cache_keys[i], outputs[i])
+        for i, (future, leader) in enumerate(claims):
+            if not leader:
+                outputs[i] = await asyncio.wrap_future(future)
+        abandoned_idx = [i for i, output in enumerate(outputs) if output is ABANDONED]
+        if abandoned_idx:
+            retried = await acached_complete(
+                [request_sizes[i] for i in abandoned_idx],
+                hedge_percentile=hedge_percentile,
+                **{**kwargs, "prompt": [inputs[i] for i in abandoned_idx]},
+            )
+            for i, choice in zip(abandoned_idx, retried.choices):
+                outputs[i] = choice
+        usage_tracker.record_cache_hits(model_name, len(inputs) - len(missing_idx) - len(abandoned_idx))
+
+        if batch_outputs is None:
             # full cache hit
-            batch_outputs = CachedCompletion(choices=cached_outputs)
-            return batch_outputs
-
-        rate_limiter.throttle(sum(request_sizes), model_name)
-        if any(hit_list):
-            # partial cache hit
-            indices_cached = [i for i, output in enumerate(hit_list) if output]
-            kwargs_copy["prompt"] = [input for input, output in zip(inputs, cached_outputs) if output is None]
-            batch_outputs = complete_with_backoff(openai.Completion.create, **kwargs_copy)
-            for idx in indices_cached:
-                batch_outputs.choices.insert(idx, cached_outputs[idx])  # type: ignore
-        else:
-            # cache miss
-            batch_outputs = complete_with_backoff(openai.Completion.create, **kwargs)
-            batch_outputs.choices = sorted(batch_outputs.choices, key=lambda x: x.index)  # type: ignore
-
-        # cache outputs
-        for i, cache_key in enumerate(cache_keys):
-            if cache_key not in cache:
-                cache.set(cache_key, batch_outputs.choices[i])  # type: ignore
+            return CachedCompletion(choices=outputs)
+        batch_outputs.choices = outputs  # type: ignore
     else:
-        rate_limiter.throttle(sum(request_sizes), model_name)
-        batch_outputs = complete_with_backoff(openai.Completion.create, **kwargs)
+        await rate_limiter.athrottle(sum(request_sizes), model_name)
+        batch_outputs = await acomplete_with_backoff(
+            openai.Completion.acreate,
+            hedge_percentile=hedge_percentile,
+            before_hedge=lambda: rate_limiter.athrottle(sum(request_sizes), model_name),
+            **kwargs,
+        )
+        usage_tracker.record_response(model_name, batch_outputs, get_cost_per_1k_tokens(model_name))
         batch_outputs.choices = sorted(batch_outputs.choices, key=lambda x: x.index)  # type: ignore
 
     return batch_outputs
 
 
+def cached_complete(request_sizes, **kwargs):
+    return run_sync(acached_complete(request_sizes, **kwargs))
+
+
 class OpenAIAPI(Model):
-    def __init__(self, model_name="ada", max_parallel=20, log_requests=True):
+    """OpenAI Completion API client.
+
+    All requests go through a shared asyncio event loop (see `src.models.concurrency`), as batches of up to
+    `max_parallel` prompts. How many batches are in flight at once is decided per model by an AIMD controller,
+    which grows the window while responses are healthy and cuts it on rate limit errors or latency spikes.
+    The synchronous methods (`generate`, `cond_log_prob`, ...) are thin wrappers around their `a`-prefixed
+    coroutine versions.
+
+    `max_concurrency` only bounds how many batches the streaming methods queue up ahead of the consumer.
+
+    With `hedge_percentile` (e.g. 95), a request that takes longer than that percentile of the model's recent
+    latencies is sent again and the first response is used; `get_hedger(model_name).stats()` shows how often.
+    """
+
+    def __init__(self, model_name="ada", max_parallel=20, log_requests=True, max_concurrency=32, hedge_percentile=None):
         self.queries = []
         self.name = model_name
         self.max_parallel = max_parallel
+        self.max_concurrency = max_concurrency
+        self.hedge_percentile = hedge_percentile
         self.tokenizer = tiktoken.get_encoding("gpt2")
+        self.token_counter = get_token_counter("gpt2")
         self.log_requests = log_requests
-        os.makedirs(os.path.join(CACHE_DIR, "completion_log"), exist_ok=True)
 
     def generate(
         self,
@@ -173,69 +291,158 @@ class OpenAIAPI(Model):
         do_sample=False,
         **kwargs,
     ):
-        if isinstance(inputs, str):
-            inputs = [inputs]
-        outputs = []
-
-        n_batches = int(np.ceil(len(inputs) / self.max_parallel))
-        for batch_idx in range(n_batches):
-            batch_inputs = inputs[batch_idx * self.max_parallel : (batch_idx + 1) * self.max_parallel]
-            batch_outputs = self._complete(
-                prompt=batch_inputs,
+        return run_sync(
+            self.agenerate(
+                inputs,
                 max_tokens=max_tokens,
-                stop=stop_string,
+                stop_string=stop_string,
                 temperature=temperature,
-                n=n_choices,
+                n_choices=n_choices,
                 **kwargs,
             )
-            for completion in batch_outputs.choices:  # type: ignore
-                outputs.append(completion.text)
+        )
+
+    async def agenerate(
+        self,
+        inputs,
+        max_tokens=500,
+        stop_string=None,
+        temperature=0,
+        n_choices=1,
+        # not used, but needed for compatibility
+        do_sample=False,
+        **kwargs,
+    ):
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        batch_outputs = await self._acomplete_batches(
+            inputs,
+            max_tokens=max_tokens,
+            stop=stop_string,
+            temperature=temperature,
+            n=n_choices,
+            **kwargs,
+        )
+
+        return [completion.text for outputs in batch_outputs for completion in outputs.choices]  # type: ignore
+
+    def generate_stream(
+        self,
+        inputs,
+        max_tokens=500,
+        stop_string=None,
+        temperature=0,
+        n_choices=1,
+        # not used, but needed for compatibility
+        do_sample=False,
+        **kwargs,
+    ) -> Iterator[Tuple[int, str]]:
+        """Like `generate`, but yields (index, completion) pairs as soon as each batch finishes.
+
+        Indices refer to positions in the list `generate` would return. Completions arrive in no particular order.
+        """
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        request_sizes = self.token_counter.count_many(inputs)
+        batches = rate_limiter.plan_batches(self.name, request_sizes, self.max_parallel)
+        batch_coroutines = (
+            (
+                start,
+                self._acomplete(
+                    request_sizes=request_sizes[start:end],
+                    prompt=inputs[start:end],
+                    max_tokens=max_tokens,
+                    stop=stop_string,
+                    temperature=temperature,
+                    n=n_choices,
+                    **kwargs,
+                ),
+            )
+            for start, end in batches
+        )
+        for start, batch_outputs in self._stream_results(batch_coroutines):
+            for i, completion in enumerate(batch_outputs.choices):  # type: ignore
+                yield start * n_choices + i, completion.text
+
+    def _stream_results(self, coroutines: Iterator[Tuple[Any, Coroutine]]) -> Iterator[Tuple[Any, Any]]:
+        """Run (key, coroutine) pairs on the API event loop and yield (key, result) pairs in completion order.
 
-        return outputs
+        Coroutines are only created and submitted when there's room, so at most `max_concurrency` of them are
+        in flight (or finished but not yet consumed) at any time. Closing the generator cancels pending requests.
+        """
+        pending = {}
+
+        def submit_next():
+            next_item = next(coroutines, None)
+            if next_item is not None:
+                key, coroutine = next_item
+                pending[submit(coroutine)] = key
+
+        for _ in range(self.max_concurrency):
+            submit_next()
+        try:
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    submit_next()
+                    yield key, future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _acomplete_batches(self, prompts, **kwargs):
+        """Request completions for all prompts with:
+        - batches of at most `max_parallel` prompts, packed up-front to fit the per-request token budget
+        - as many batches in flight at once as the model's AIMD window allows
+
+        Returns the batch outputs in input order.
+        """
+        request_sizes = self.token_counter.count_many(prompts)
+        batches = rate_limiter.plan_batches(self.name, request_sizes, self.max_parallel)
+
+        return await asyncio.gather(
+            *[self._acomplete(request_sizes=request_sizes[start:end], prompt=prompts[start:end], **kwargs) for start, end in batches]
+        )
 
     def _complete(self, **kwargs):
-        """Request OpenAI API Completion with:
+        prompts = kwargs.pop("prompt")
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        batch_outputs = run_sync(self._acomplete_batches(prompts, **kwargs))
+        return CachedCompletion(choices=[choice for outputs in batch_outputs for choice in outputs.choices])  # type: ignore
+
+    async def _acomplete(self, request_sizes=None, **kwargs):
+        """Request OpenAI API Completion for a single batch with:
         - request throttling
-        - request splitting
         - persistent caching
+
+        `request_sizes` are the prompts' token counts, computed here if not given.
         """
 
         model_name = self.name
         kwargs["model"] = model_name
-        request_sizes = [len(self.tokenizer.encode(prompt)) for prompt in kwargs["prompt"]]
-        max_batch_size = rate_limiter.get_max_batch_size(model_name, request_sizes)
-
-        # decide if need to split the request
-        if max_batch_size < len(kwargs["prompt"]):
-            kwargs_A = kwargs.copy()
-            kwargs_A["prompt"] = kwargs["prompt"][:max_batch_size]
-            kwargs_B = kwargs.copy()
-            kwargs_B["prompt"] = kwargs["prompt"][max_batch_size:]
-
-            completionA = self._complete(**kwargs_A)
-            completionB = self._complete(**kwargs_B)
-            completionA.choices.extend(completionB.choices)  # type: ignore
-            return completionA
-
-        batch_outputs = cached_complete(request_sizes, **kwargs)
-
-        # log request
-        n_tokens_sent = sum([len(self.tokenizer.encode(prompt)) for prompt in kwargs["prompt"]])
-        n_tokens_received = sum(
-            [
-                len(self.tokenizer.encode(choice.text.replace(kwargs["prompt"][i], "")))
-                for i, choice in enumerate(batch_outputs.choices)  # type: ignore
-            ]
-        )
+        if request_sizes is None:
+            request_sizes = self.token_counter.count_many(kwargs["prompt"])
+
+        batch_outputs = await acached_complete(request_sizes, hedge_percentile=self.hedge_percentile, **kwargs)
 
-        n_tokens_total = n_tokens_sent + n_tokens_received
-        cost = (n_tokens_total / 1000) * get_cost_per_1k_tokens(model_name)
-        timestamp_str = time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime()) + f".{int(time.time() * 1000) % 1000:03d}"
         if self.log_requests:
+            # the tokens the API billed for, none if every prompt was answered from the cache
+            usage = getattr(batch_outputs, "usage", None) or {}
+            n_tokens_sent = usage.get("prompt_tokens", 0)
+            n_tokens_received = usage.get("completion_tokens", 0)
+            cost = ((n_tokens_sent + n_tokens_received) / 1000) * get_cost_per_1k_tokens(model_name)
+            # echoed completions start with their prompt, which isn't worth logging twice
+            n, echo = kwargs.get("n", 1), kwargs.get("echo", False)
+            completions = [
+                choice.text[len(kwargs["prompt"][i // n]) :] if echo else choice.text for i, choice in enumerate(batch_outputs.choices)  # type: ignore
+            ]
             self.log_request(
                 kwargs,
-                batch_outputs,
-                timestamp_str,
+                completions,
                 model_name,
                 n_tokens_sent,
                 n_tokens_received,
@@ -246,28 +453,25 @@ class OpenAIAPI(Model):
     def log_request(
         self,
         kwargs,
-        batch_outputs,
-        timestamp_str,
+        completions,
         model_name,
         n_tokens_sent,
         n_tokens_received,
         cost,
     ):
-        with open(
-            os.path.join(CACHE_DIR, "completion_log", f"{timestamp_str}-{model_name}.txt"),
-            "a",
-        ) as f:
-            f.write("<REQUEST METADATA AFTER NEWLINE>\n")
-            f.write(
-                f"Request {timestamp_str} with {len(batch_outputs.choices)} prompts. Tokens sent: {n_tokens_sent}. Tokens received: {n_tokens_received}. Cost: ${cost:.4f}\n"
-            )
-            for i, choice in enumerate(batch_outputs.choices):
-                f.write(f"\n<PROMPT #{i+1} of {len(batch_outputs.choices)} AFTER NEWLINE>\n")
-                prompt = kwargs["prompt"][i]
-                completion = choice.text.replace(prompt, "")
-                f.write(prompt)
-                f.write("<COMPLETION_START>" + completion)
-                f.write("<COMPLETION_END>\n\n")
+        get_journal().log(
+            {
+                "client": "completion",
+                "model": model_name,
+                "n_prompts": len(completions),
+                "n_tokens_sent": n_tokens_sent,
+                "n_tokens_received": n_tokens_received,
+                "cost": cost,
+                "concurrency_window": get_concurrency_controller(model_name).window,
+                "prompts": kwargs["prompt"],
+                "completions": completions,
+            }
+        )
 
     def _flatten_multiple_choice_examples(self, inputs, targets):
         flat_idx = []
@@ -344,7 +548,9 @@ class OpenAIAPI(Model):
             completions: greedy completions
             scores: non-normalized logprobs for the first token of each option
         """
+        return run_sync(self.amultiple_choice_via_completion(inputs, options, max_tokens=max_tokens))
 
+    async def amultiple_choice_via_completion(self, inputs, options, max_tokens=500) -> Tuple[List[str], List[List[float]]]:
         if isinstance(options, str):
             options = [options]
 
@@ -352,31 +558,35 @@ class OpenAIAPI(Model):
             inputs = [inputs]
             options = [options]
 
-        num_examples = len(inputs)
-        batch_size = self.max_parallel
+        batch_outputs = await self._acomplete_batches(
+            inputs,
+            max_tokens=max_tokens,
+            temperature=0,
+            logprobs=5,
+        )
+
         completions = []
         scores = []
-        for idx in range(0, num_examples, batch_size):
-            batch_inputs = inputs[idx : min(idx + batch_size, num_examples)]
-            batch_choices = options[idx : min(idx + batch_size, num_examples)]
+        flat_choices = [completion for outputs in batch_outputs for completion in outputs.choices]  # type: ignore
+        for i, completion in enumerate(flat_choices):
+            target_logprobs = self._get_decisive_logprobs(completion, options[i])
+            scores.append(target_logprobs)
+            completions.append(completion.text)
 
-            batch_outputs = self._complete(
-                prompt=batch_inputs,
-                max_tokens=max_tokens,
-                temperature=0,
-                logprobs=5,
-            )
+        return completions, scores
 
-            for i, completion in enumerate(batch_outputs.choices):  # type: ignore
-                target_logprobs = self._get_decisive_logprobs(completion, batch_choices[i])
-                scores.append(target_logprobs)
-                completions.append(completion.text)
+    def cond_log_prob(self, inputs, targets, absolute_normalization=False) -> List[np.ndarray]:
+        """Get conditional log probability of targets given inputs.
 
-        return completions, scores
+        Returns one array of scores per input, with one score per target.
+        """
+        return run_sync(self.acond_log_prob(inputs, targets, absolute_normalization=absolute_normalization))
 
-    def cond_log_prob(self, inputs, targets, absolute_normalization=False):
-        """Get conditional log probability of targets given inputs."""
+    def cond_log_prob_stream(self, inputs, targets, absolute_normalization=False) -> Iterator[Tuple[int, np.ndarray]]:
+        """Like `cond_log_prob`, but yields (input index, scores) pairs as soon as each input's targets are scored.
 
+        Inputs are scored in chunks of about `max_parallel` (input, target) pairs, in no particular order.
+        """
         if isinstance(targets, str):
             targets = [targets]
 
@@ -384,42 +594,70 @@ class OpenAIAPI(Model):
             inputs = [inputs]
             targets = [targets]
 
-        flat_idx, flat_inputs, flat_choices = self._flatten_multiple_choice_examples(inputs=inputs, targets=targets)
-        num_examples = len(flat_idx)
-        flat_scores = []
-        batch_size = self.max_parallel
-        for idx in range(0, num_examples, batch_size):
-            batch_idx = flat_idx[idx : min(idx + batch_size, num_examples)]
-            batch_inputs = flat_inputs[idx : min(idx + batch_size, num_examples)]
-            batch_choices = flat_choices[idx : min(idx + batch_size, num_examples)]
-
-            batch_queries = [inpt + target for inpt, target in zip(batch_inputs, batch_choices)]
-            batch_outputs = self._complete(
-                prompt=batch_queries,
+        def chunks():
+            start, n_pairs = 0, 0
+            for i, choices in enumerate(targets):
+                if i > start and n_pairs + len(choices) > self.max_parallel:
+                    yield start, i
+                    start, n_pairs = i, 0
+                n_pairs += len(choices)
+            if start < len(inputs):
+                yield start, len(inputs)
+
+        chunk_coroutines = (
+            (start, self.acond_log_prob(inputs[start:end], targets[start:end], absolute_normalization=absolute_normalization))
+            for start, end in chunks()
+        )
+        for start, chunk_scores in self._stream_results(chunk_coroutines):
+            for i, scores in enumerate(chunk_scores):
+                yield start + i, scores
+
+    async def acond_log_prob(self, inputs, targets, absolute_normalization=False) -> List[np.ndarray]:
+        if isinstance(targets, str):
+            targets = [targets]
+
+        if isinstance(inputs, str):
+            inputs = [inputs]
+            targets = [targets]
+
+        if len(inputs) == 0:
+            return []
+
+        _, flat_inputs, flat_choices = self._flatten_multiple_choice_examples(inputs=inputs, targets=targets)
+        row_ends = np.cumsum([len(choices) for choices in targets], dtype=int)
+
+        # score each distinct (input, target) pair once, reusing scores cached by previous calls
+        pairs = list(zip(flat_inputs, flat_choices))
+        unique_pairs = list(dict.fromkeys(pairs))
+        pair_keys = cache.make_keys({"model": self.name, "kind": "target_logprob"}, [inpt + "\0" + target for inpt, target in unique_pairs])
+        loop = asyncio.get_running_loop()
+        cached_scores = await loop.run_in_executor(None, cache.get_many, pair_keys)
+        unique_scores = np.array([np.nan if score is None else score for score in cached_scores], dtype=float)
+
+        missing_idx = np.flatnonzero(np.isnan(unique_scores))
+        if len(missing_idx) > 0:
+            batch_outputs = await self._acomplete_batches(
+                [unique_pairs[i][0] + unique_pairs[i][1] for i in missing_idx],
                 max_tokens=0,
                 temperature=0,
                 logprobs=1,
                 echo=True,
             )
+            completions = [completion for outputs in batch_outputs for completion in outputs.choices]  # type: ignore
+            for i, completion in zip(missing_idx, completions):
+                unique_scores[i] = self._get_target_logprobs(completion, unique_pairs[i][1])
+            await loop.run_in_executor(None, cache.set_many, [(pair_keys[i], float(unique_scores[i])) for i in missing_idx])
+        get_usage_tracker().record_cache_hits(self.name, len(unique_pairs) - len(missing_idx))
 
-            for i, completion in enumerate(batch_outputs.choices):  # type: ignore
-                target_logprobs = self._get_target_logprobs(completion, batch_choices[i])
-                flat_scores.append(target_logprobs)
-
-        scores = [[] for _ in range(len(inputs))]
-
-        for idx, score in zip(flat_idx, flat_scores):
-            # if score == 0:
-            #     # all tokens were masked. Setting score to -inf.
-            #     print("Found score identical to zero. Probably from empty target. " "Setting score to -inf.")
-            #     scores[idx[0]].append(-np.inf)
-            # else:
-            scores[idx[0]].append(score)
+        pair_index = {pair: i for i, pair in enumerate(unique_pairs)}
+        flat_scores = unique_scores[[pair_index[pair] for pair in pairs]]
 
+        rows = np.split(flat_scores, row_ends[:-1])
         if not absolute_normalization:
-            scores = [list(score_row - scipy.special.logsumexp(score_row)) for score_row in scores]
+            # logsumexp over each row's targets; inputs without targets stay empty
+            rows = [row - np.logaddexp.reduce(row) if len(row) else row for row in rows]
 
-        return scores
+        return rows
 
     def _first_divergent_token(self, completions: List[str], prefix=" ") -> Tuple[int, List[str]]:
         """Find the first divergent token index between completions.
@@ -0,0 +1,168 @@
+"""Append-only JSONL journal of API requests.
+
+Records are queued by the clients and written by a background thread, so logging never blocks a request.
+Query the journal with:
+
+    python -m src.models.request_journal --model davinci-002 --since 2023-09-01 --min_cost 0.01
+"""
+import argparse
+import atexit
+import glob
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+JOURNAL_DIR = os.path.join("cache", "request_journal")
+
+
+class RequestJournal:
+    """Buffered, append-only JSONL request log with size-based rotation.
+
+    Every request's metadata (time, model, client, token counts, cost) is always recorded, but the prompt and
+    completion texts are only kept for a `sample_rate` fraction of requests. If the writer falls more than
+    `max_queue_size` records behind, new records are dropped (and counted) rather than blocking the caller.
+    """
+
+    def __init__(
+        self,
+        directory: str = JOURNAL_DIR,
+        max_file_bytes: int = 64 * 2**20,
+        sample_rate: float = 1.0,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 100_000,
+    ):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.n_dropped = 0
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=max_queue_size)
+        self._file = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="request-journal", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, record: Dict[str, Any]) -> None:
+        """Queue a record for writing. Never blocks."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            record = {key: value for key, value in record.items() if key not in ("prompts", "completions")}
+        record.setdefault("timestamp", time.time())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def close(self) -> None:
+        """Write out all queued records and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _open_new_file(self):
+        if self._file is not None:
+            self._file.close()
+        timestamp_str = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
+        path = os.path.join(self.directory, f"requests-{timestamp_str}-{os.getpid()}.jsonl")
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _run(self) -> None:
+        self._open_new_file()
+        done = False
+        while not done:
+            try:
+                records = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # drain whatever else is queued, so one write covers many records
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in records:
+                done = True
+                records = [record for record in records if record is not None]
+            self._file.write("".join(json.dumps(record, default=str) + "\n" for record in records))  # type: ignore
+            self._file.flush()  # type: ignore
+            if self._file.tell() > self.max_file_bytes:  # type: ignore
+                self._open_new_file()
+
+        self._file.close()  # type: ignore
+
+
+_journal: Optional[RequestJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> RequestJournal:
+    """Get the process-wide journal shared by all API clients, starting it on first use."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = RequestJournal()
+        return _journal
+
+
+def read_journal(
+    directory: str = JOURNAL_DIR,
+    model: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    min_cost: float = 0,
+) -> Iterator[Dict[str, Any]]:
+    """Iterate over journal records matching the given model, time range (unix timestamps) and minimum cost."""
+    for path in sorted(glob.glob(os.path.join(directory, "requests-*.jsonl"))):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of a file that is still being written
+                    continue
+                if model is not None and record.get("model") != model:
+                    continue
+                if since is not None and record["timestamp"] < since:
+                    continue
+                if until is not None and record["timestamp"] > until:
+                    continue
+                if record.get("cost", 0) < min_cost:
+                    continue
+                yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", type=str, default=JOURNAL_DIR)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--since", type=str, default=None, help="ISO date/time, e.g. 2023-09-01 or 2023-09-01T12:00")
+    parser.add_argument("--until", type=str, default=None, help="ISO date/time")
+    parser.add_argument("--min_cost", type=float, default=0)
+    parser.add_argument("--show_text", action="store_true", help="print prompts and completions")
+    args = parser.parse_args()
+
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    until = datetime.fromisoformat(args.until).timestamp() if args.until else None
+
+    n_requests, n_tokens_sent, n_tokens_received, total_cost = 0, 0, 0, 0.0
+    for record in read_journal(args.dir, args.model, since, until, args.min_cost):
+        n_requests += 1
+        n_tokens_sent += record.get("n_tokens_sent", 0)
+        n_tokens_received += record.get("n_tokens_received", 0)
+        total_cost += record.get("cost", 0)
+        timestamp_str = datetime.fromtimestamp(record["timestamp"]).isoformat(timespec="milliseconds")
+        print(
+            f"{timestamp_str} {record.get('client', '')} {record.get('model', '')}: {record.get('n_prompts', 1)} prompts, "
+            f"{record.get('n_tokens_sent', 0)} tokens sent, {record.get('n_tokens_received', 0)} received, ${record.get('cost', 0):.4f}"
+        )
+        if args.show_text:
+            for prompt, completion in zip(record.get("prompts", []), record.get("completions", [])):
+                print(f"{prompt}<COMPLETION_START>{completion}<COMPLETION_END>\n")
+
+    print(f"\n{n_requests} requests, {n_tokens_sent} tokens sent, {n_tokens_received} tokens received, total cost ${total_cost:.4f}")
@@ -1,4 +1,8 @@
-import pandas
+import asyncio
+import atexit
+import json
+import sqlite3
+import threading
 import time
 import os
 from tenacity.wait import wait_exponential
@@ -38,12 +42,183 @@ class wait_random_exponential(wait_exponential):
         return random.uniform(self.min, high)
 
 
+class TokenBucket:
+    """A bucket holding up to `capacity` units, refilled continuously at `capacity / window` units per second."""
+
+    __slots__ = ("capacity", "refill_rate", "level", "timestamp")
+
+    def __init__(self, capacity: float, window: float, level=None, timestamp=None):
+        self.capacity = capacity
+        self.refill_rate = capacity / window
+        self.level = capacity if level is None else level
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.timestamp) * self.refill_rate)
+        self.timestamp = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they are available now). Assumes a fresh refill()."""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.refill_rate)
+
+    def consume(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        """Return `amount` units (or take more, if negative), keeping the debt at most one full bucket."""
+        self.level = max(-self.capacity, min(self.capacity, self.level + amount))
+
+
+def admit(request_bucket: TokenBucket, token_bucket: TokenBucket, n_tokens: float, now: float) -> float:
+    """Refill both buckets and consume one request and `n_tokens` tokens if both have capacity.
+
+    Returns:
+        float: 0 if the request was admitted, otherwise the number of seconds to wait before trying again
+    """
+    request_bucket.refill(now)
+    token_bucket.refill(now)
+    wait = max(request_bucket.wait_time(1), token_bucket.wait_time(n_tokens))
+    if wait == 0:
+        request_bucket.consume(1)
+        token_bucket.consume(n_tokens)
+    return wait
+
+
+class LocalBucketStore:
+    """Bucket state kept in this process only, persisted to one JSON file per model
+    every `PERSIST_INTERVAL_SEC` and on exit, so a restarted process doesn't start with a full budget.
+    """
+
+    PERSIST_INTERVAL_SEC = 10
+
+    def __init__(self, state_dir, persist=True):
+        self.state_dir = state_dir
+        self.persist = persist
+        # model name -> (request bucket, token bucket)
+        self.buckets = {}
+        self.last_persisted = time.time()
+        # buckets are shared between threads and the event loop
+        self._lock = threading.Lock()
+        if self.persist:
+            os.makedirs(self.state_dir, exist_ok=True)
+            atexit.register(self.save)
+
+    def acquire(self, model_name, n_tokens, token_limit, request_limit, window) -> float:
+        with self._lock:
+            if model_name not in self.buckets:
+                state = self._load_state(model_name) if self.persist else {}
+                self.buckets[model_name] = (
+                    TokenBucket(request_limit, window, state.get("requests"), state.get("timestamp")),
+                    TokenBucket(token_limit, window, state.get("tokens"), state.get("timestamp")),
+                )
+            now = time.time()
+            wait = admit(*self.buckets[model_name], n_tokens, now)
+            should_persist = self.persist and now - self.last_persisted > self.PERSIST_INTERVAL_SEC
+
+        if should_persist:
+            self.save()
+        return wait
+
+    def refund(self, model_name, n_tokens, token_limit, request_limit, window) -> None:
+        with self._lock:
+            if model_name in self.buckets:
+                _, token_bucket = self.buckets[model_name]
+                token_bucket.refund(n_tokens)
+
+    def _state_file(self, model_name):
+        return os.path.join(self.state_dir, f"{model_name}.json")
+
+    def _load_state(self, model_name):
+        try:
+            with open(self._state_file(model_name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        """Persist the current bucket levels of all models to disk."""
+        with self._lock:
+            self.last_persisted = time.time()
+            states = {
+                model_name: {"requests": request_bucket.level, "tokens": token_bucket.level, "timestamp": token_bucket.timestamp}
+                for model_name, (request_bucket, token_bucket) in self.buckets.items()
+            }
+        for model_name, state in states.items():
+            with open(self._state_file(model_name), "w") as f:
+                json.dump(state, f)
+
+
+class SQLiteBucketStore:
+    """Bucket state shared by all processes on this machine through a SQLite database in WAL mode.
+
+    Every admission is one short `BEGIN IMMEDIATE` transaction (read the model's row, refill, consume, write back),
+    so concurrent evaluation jobs draw from a single per-model budget instead of each assuming the whole quota.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (model TEXT PRIMARY KEY, requests REAL, tokens REAL, timestamp REAL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, model_name, n_tokens, token_limit, request_limit, window) -> float:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT requests, tokens, timestamp FROM buckets WHERE model = ?", (model_name,)).fetchone()
+            requests_level, tokens_level, timestamp = row if row is not None else (None, None, None)
+            request_bucket = TokenBucket(request_limit, window, requests_level, timestamp)
+            token_bucket = TokenBucket(token_limit, window, tokens_level, timestamp)
+            wait = admit(request_bucket, token_bucket, n_tokens, time.time())
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (model, requests, tokens, timestamp) VALUES (?, ?, ?, ?)",
+                (model_name, request_bucket.level, token_bucket.level, token_bucket.timestamp),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def refund(self, model_name, n_tokens, token_limit, request_limit, window) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, timestamp FROM buckets WHERE model = ?", (model_name,)).fetchone()
+            if row is not None:
+                # the timestamp is shared with the request bucket, so adjust the level without refilling
+                token_bucket = TokenBucket(token_limit, window, *row)
+                token_bucket.refund(n_tokens)
+                conn.execute("UPDATE buckets SET tokens = ? WHERE model = ?", (token_bucket.level, model_name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
 class RateLimiter:
-    """Rate limiter for OpenAI API calls, using a timestamp sliding window,
-    storing each request's timestamp and # of tokens in a pandas dataframe.
+    """Rate limiter for OpenAI API calls, using two token buckets per model:
+    one for requests and one for tokens, each refilled over a window (1 min).
+
+    Admission is O(1): if both buckets have capacity the request goes through
+    immediately, otherwise the caller sleeps exactly until there is enough capacity.
 
-    If the number of tokens within a sliding window (1 min) exceeds the limit,
-    sleep for a second and check again until there's enough capacity.
+    By default the buckets live in a SQLite database under `RATE_LIMIT_DIR`, so all
+    processes (and both the completion and chat clients) share one budget per model.
+    Pass `store=LocalBucketStore(...)` to keep the budget private to this process.
     """
 
     # multipliers for default rate limits
@@ -71,82 +246,83 @@ class RateLimiter:
         },
     }
 
-    def __init__(self, time_period_sec=60):
+    def __init__(self, time_period_sec=60, store=None):
         self.window = time_period_sec
-        self.model_requests = {}
-        os.makedirs(self.RATE_LIMIT_DIR, exist_ok=True)
+        self.store = store or SQLiteBucketStore(os.path.join(self.RATE_LIMIT_DIR, "buckets.sqlite3"))
 
-    def get_max_batch_size(self, model, prompt_sizes):
-        """Get the maximum batch size for a given model, given the prompt sizes.
+    def get_rate_limits(self, model_name):
+        """Get the (token limit, request limit) per window for a model."""
+        if model_name in self.custom_rate_limits:
+            return self.custom_rate_limits[model_name]["tokens"], self.custom_rate_limits[model_name]["requests"]
+        return self.DEFAULT_TOKEN_LIMIT, self.DEFAULT_REQUEST_LIMIT
+
+    def plan_batches(self, model, prompt_sizes, max_prompts_per_batch):
+        """Pack prompts (in order) into request batches, each with at most `max_prompts_per_batch` prompts
+        and at most the per-request share of the token limit (a single larger prompt gets a batch of its own).
 
         Args:
             model (str): model name
             prompt_sizes (list): list of prompt sizes
+            max_prompts_per_batch (int): maximum number of prompts per request
 
         Returns:
-            int: maximum batch size
+            list: (start, end) index ranges into `prompt_sizes`, one per batch
         """
-        # get per-minute rate limits
-        if model in self.custom_rate_limits:
-            token_limit_per_min = self.custom_rate_limits[model]["tokens"]
-        else:
-            token_limit_per_min = self.DEFAULT_TOKEN_LIMIT
-
+        token_limit_per_min, _ = self.get_rate_limits(model)
         token_limit_per_batch = token_limit_per_min / self.window
 
+        batches = []
+        start = 0
         tokens_used = 0
-        requests_used = 0
-
-        # calculate max batch size
-        for prompt_size in prompt_sizes:
+        for i, prompt_size in enumerate(prompt_sizes):
+            if i > start and (tokens_used + prompt_size > token_limit_per_batch or i - start >= max_prompts_per_batch):
+                batches.append((start, i))
+                start = i
+                tokens_used = 0
             tokens_used += prompt_size
-            if tokens_used > token_limit_per_batch:
-                break
-            requests_used += 1
+        if start < len(prompt_sizes):
+            batches.append((start, len(prompt_sizes)))
+
+        return batches
+
+    def acquire(self, n_tokens, model_name) -> float:
+        """Try to admit one request of `n_tokens` tokens.
+
+        Returns:
+            float: 0 if the request was admitted, otherwise the number of seconds to wait before trying again
+        """
+        token_limit, request_limit = self.get_rate_limits(model_name)
+        return self.store.acquire(model_name, n_tokens, token_limit, request_limit, self.window)
 
-        return requests_used
+    def reconcile(self, n_tokens_estimated, n_tokens_used, model_name) -> None:
+        """Correct the token budget once a request's actual usage is known, refunding an overestimate
+        (or charging an underestimate) made when it was admitted."""
+        if n_tokens_estimated != n_tokens_used:
+            token_limit, request_limit = self.get_rate_limits(model_name)
+            self.store.refund(model_name, n_tokens_estimated - n_tokens_used, token_limit, request_limit, self.window)
+
+    async def areconcile(self, n_tokens_estimated, n_tokens_used, model_name) -> None:
+        """Like `reconcile`, but on a worker thread, see `athrottle`."""
+        if n_tokens_estimated != n_tokens_used:
+            await asyncio.get_running_loop().run_in_executor(None, self.reconcile, n_tokens_estimated, n_tokens_used, model_name)
 
     def throttle(self, n_tokens, model_name) -> None:
-        # get rate limits
-        if model_name in self.custom_rate_limits:
-            token_limit = self.custom_rate_limits[model_name]["tokens"]
-            request_limit = self.custom_rate_limits[model_name]["requests"]
-        else:
-            token_limit = self.DEFAULT_TOKEN_LIMIT
-            request_limit = self.DEFAULT_REQUEST_LIMIT
-
-        # get model request history
-        state_file = os.path.join(self.RATE_LIMIT_DIR, f"{model_name}.csv")
-        if model_name not in self.model_requests:
-            if os.path.exists(state_file):
-                self.model_requests[model_name] = pandas.read_csv(state_file)
-                self.model_requests[model_name]["timestamp"] = pandas.to_datetime(self.model_requests[model_name]["timestamp"])
-            else:
-                self.model_requests[model_name] = pandas.DataFrame(columns=["timestamp", "n_tokens"])
-
-        # add new request to history
-        requests = self.model_requests[model_name]
-        now = pandas.Timestamp.now()
-        requests = pandas.concat(
-            [requests, pandas.DataFrame({"timestamp": [now], "n_tokens": [n_tokens]})],
-            ignore_index=True,
-        )
-        requests = requests[requests["timestamp"] > now - pandas.Timedelta(seconds=self.window)]  # pyright: ignore
-
-        # respect request limit
-        sleep_time = 1 / (request_limit / self.window)  # 1 / (20 / 60s) = 3s
-        time.sleep(sleep_time)
-
-        # wait until we're not over the limit
-        while requests["n_tokens"].sum() > token_limit or len(requests) > request_limit:
-            print(
-                f'Rate limit exceeded for {model_name}, sleeping for 1 second (tokens: {requests["n_tokens"].sum()}/{token_limit}, requests: {len(requests)}/{request_limit})'
-            )
-            time.sleep(1)
-            now = pandas.Timestamp.now()
-            requests = requests[requests["timestamp"] > now - pandas.Timedelta(seconds=self.window)]  # pyright: ignore
-
-        # save history and persist to disk
-        self.model_requests[model_name] = requests
-        self.model_requests[model_name].to_csv(state_file, index=False)
-        return
+        """Block until a request of `n_tokens` tokens can be sent to `model_name`."""
+        wait = self.acquire(n_tokens, model_name)
+        while wait > 0:
+            print(f"Rate limit exceeded for {model_name}, sleeping for {wait:.2f} seconds (request of {n_tokens} tokens)")
+            time.sleep(wait)
+            wait = self.acquire(n_tokens, model_name)
+
+    async def athrottle(self, n_tokens, model_name) -> None:
+        """Like `throttle`, but yields to the event loop while waiting.
+
+        The store is called on a worker thread: the SQLite store can block for a while on the database lock
+        when other processes hold it, which would otherwise stall every request on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        wait = await loop.run_in_executor(None, self.acquire, n_tokens, model_name)
+        while wait > 0:
+            print(f"Rate limit exceeded for {model_name}, sleeping for {wait:.2f} seconds (request of {n_tokens} tokens)")
+            await asyncio.sleep(wait)
+            wait = await loop.run_in_executor(None, self.acquire, n_tokens, model_name)
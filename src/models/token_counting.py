@@ -0,0 +1,84 @@
+import functools
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Sequence
+
+import tiktoken
+
+
+class TokenCounter:
+    """Counts tokens with a tiktoken encoding, remembering the counts of recently seen texts.
+
+    Counts are kept in a bounded LRU keyed by the text's hash (so the texts themselves aren't retained),
+    and all texts missing from it are tokenised in a single `encode_ordinary_batch` call.
+    """
+
+    def __init__(self, encoding: tiktoken.Encoding, max_size: int = 2**16):
+        self.encoding = encoding
+        self.max_size = max_size
+        self._counts: "OrderedDict[int, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: Sequence[str]) -> List[int]:
+        keys = [hash(text) for text in texts]
+        counts: List[int] = [0] * len(texts)
+        missing_idx = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                count = self._counts.get(key)
+                if count is None:
+                    missing_idx.append(i)
+                else:
+                    self._counts.move_to_end(key)
+                    counts[i] = count
+
+        if missing_idx:
+            encoded = self.encoding.encode_ordinary_batch([texts[i] for i in missing_idx])
+            with self._lock:
+                for i, tokens in zip(missing_idx, encoded):
+                    counts[i] = len(tokens)
+                    self._counts[keys[i]] = len(tokens)
+                while len(self._counts) > self.max_size:
+                    self._counts.popitem(last=False)
+
+        return counts
+
+
+_token_counters = {}
+_token_counters_lock = threading.Lock()
+
+
+def get_token_counter(encoding_name: str) -> TokenCounter:
+    """Get the process-wide TokenCounter for a tiktoken encoding, so all clients share one LRU."""
+    with _token_counters_lock:
+        if encoding_name not in _token_counters:
+            _token_counters[encoding_name] = TokenCounter(tiktoken.get_encoding(encoding_name))
+        return _token_counters[encoding_name]
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding_name(model_name: str) -> str:
+    """Name of the tiktoken encoding used by a model, defaulting to cl100k_base (all chat models) for unknown models."""
+    try:
+        return tiktoken.encoding_for_model(model_name).name
+    except KeyError:
+        return "cl100k_base"
+
+
+def count_message_tokens(messages: Sequence[Dict[str, str]], model_name: str) -> int:
+    """Estimate the prompt tokens of a chat request the way the API counts them,
+    following `num_tokens_from_messages` in the OpenAI cookbook: every message's fields, a few tokens
+    of per-message overhead, and 3 tokens priming the assistant's reply.
+    """
+    if model_name == "gpt-3.5-turbo-0301":
+        tokens_per_message, tokens_per_name = 4, -1
+    else:
+        tokens_per_message, tokens_per_name = 3, 1
+
+    counter = get_token_counter(get_encoding_name(model_name))
+    n_tokens = sum(counter.count_many([value for message in messages for value in message.values()]))
+    n_tokens += tokens_per_message * len(messages) + tokens_per_name * sum("name" in message for message in messages)
+    return n_tokens + 3
@@ -0,0 +1,167 @@
+"""In-memory accounting of API usage: requests, tokens, cache hits and dollars, per model and per script.
+
+The clients record every response (using the `usage` the API returns, so nothing is re-tokenised) and every
+cache hit. Read the totals at any time, or have them written out when the process exits:
+
+    print(get_usage_tracker().to_prometheus())
+    get_usage_tracker().export("cache/usage/run.json")
+
+    OPENAI_USAGE_EXPORT=cache/usage/run.prom python scripts/...
+
+Exports are JSON, or Prometheus text exposition format if the path ends in `.prom`.
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EXPORT_PATH_ENV = "OPENAI_USAGE_EXPORT"
+
+
+@dataclass
+class UsageCounters:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hits: int = 0
+    cost: float = 0.0
+
+
+# metric name and help text for each counter, in Prometheus export order
+PROMETHEUS_METRICS = {
+    "requests": ("openai_requests_total", "API requests answered."),
+    "prompt_tokens": ("openai_prompt_tokens_total", "Prompt tokens billed."),
+    "completion_tokens": ("openai_completion_tokens_total", "Completion tokens billed."),
+    "cache_hits": ("openai_cache_hits_total", "Prompts, samples or scores served from a cache instead of the API."),
+    "cost": ("openai_cost_dollars_total", "Estimated cost in dollars."),
+}
+
+
+def default_script_name() -> str:
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "interactive"
+
+
+class UsageTracker:
+    """Thread-safe usage counters, keyed by (model, script).
+
+    `script` defaults to the file name of the running script. It is a label rather than a constant so that
+    exports from several processes can be concatenated and still be told apart.
+    """
+
+    def __init__(self, script: Optional[str] = None):
+        self.script = script or default_script_name()
+        self._counters: Dict[Tuple[str, str], UsageCounters] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        model_name: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cost: float = 0.0,
+        requests: int = 1,
+        cache_hits: int = 0,
+    ) -> None:
+        with self._lock:
+            counters = self._counters.setdefault((model_name, self.script), UsageCounters())
+            counters.requests += requests
+            counters.prompt_tokens += prompt_tokens
+            counters.completion_tokens += completion_tokens
+            counters.cache_hits += cache_hits
+            counters.cost += cost
+
+    def record_response(self, model_name: str, response: Any, cost_per_1k_tokens: float) -> Tuple[int, int, float]:
+        """Count one API response by its `usage` field. Returns (prompt tokens, completion tokens, cost)."""
+        usage = getattr(response, "usage", None) or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cost = (prompt_tokens + completion_tokens) / 1000 * cost_per_1k_tokens
+        self.record(model_name, prompt_tokens, completion_tokens, cost)
+        return prompt_tokens, completion_tokens, cost
+
+    def record_cache_hits(self, model_name: str, n: int) -> None:
+        if n:
+            self.record(model_name, requests=0, cache_hits=n)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """One row of counters per (model, script)."""
+        with self._lock:
+            return [
+                {"model": model_name, "script": script, **asdict(counters)}
+                for (model_name, script), counters in sorted(self._counters.items())
+            ]
+
+    def totals(self) -> UsageCounters:
+        total = UsageCounters()
+        for row in self.snapshot():
+            for field in PROMETHEUS_METRICS:
+                setattr(total, field, getattr(total, field) + row[field])
+        return total
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        rows = self.snapshot()
+        lines = []
+        for field, (metric, help_text) in PROMETHEUS_METRICS.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for row in rows:
+                labels = f'model="{_escape_label(row["model"])}",script="{_escape_label(row["script"])}"'
+                lines.append(f"{metric}{{{labels}}} {row[field]}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        """Write the counters to `path`, as Prometheus text if it ends in `.prom` and as JSON otherwise."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus() if path.endswith(".prom") else self.to_json())
+
+    def summary(self) -> str:
+        total = self.totals()
+        return (
+            f"{total.requests} API requests, {total.prompt_tokens} prompt + {total.completion_tokens} completion tokens, "
+            f"{total.cache_hits} cache hits, ${total.cost:.4f}"
+        )
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_tracker: Optional[UsageTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_usage_tracker() -> UsageTracker:
+    """Get the process-wide usage tracker shared by all API clients."""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = UsageTracker()
+        return _tracker
+
+
+def _report_at_exit() -> None:
+    if _tracker is None or not _tracker.snapshot():
+        return
+    logger.info("OpenAI usage: %s", _tracker.summary())
+    path = os.getenv(EXPORT_PATH_ENV)
+    if path:
+        _tracker.export(path)
+
+
+atexit.register(_report_at_exit)
@@ -75,16 +75,27 @@ def get_city_query(region: str) -> list[ChatMessage]:
     return initial + [ChatMessage("user", question)]
 
 
+def parse_city_response(region: str, response: str) -> RegionCityPair | None:
+    city = parse_response(response)
+    return RegionCityPair(region, city) if city is not None else None
+
+
 def query_city(region: str, model_name: str = MODEL) -> RegionCityPair | None:
     model = OpenAIChatAPI(model=model_name)
-    resp = parse_response(model.generate(get_city_query(region)))
-    return RegionCityPair(region, resp) if resp is not None else None
+    return parse_city_response(region, model.generate(get_city_query(region)))
 
 
 def get_city(region: str, model_name: str = MODEL) -> RegionCityPair | None:
     return query_city(region, model_name=model_name)
 
 
+def get_cities(regions: list[str], model_name: str = MODEL) -> list[RegionCityPair | None]:
+    """Batched `get_city`, querying all regions concurrently."""
+    model = OpenAIChatAPI(model=model_name)
+    responses = model.generate_many([get_city_query(region) for region in regions])
+    return [parse_city_response(region, response) for region, response in zip(regions, responses)]
+
+
 @memory.cache
 def get_region(
     city: str,
@@ -78,15 +78,26 @@ def get_person_query(organization: str) -> list[ChatMessage]:
     return initial_messages + [ChatMessage("user", question_str)]
 
 
+def parse_person_response(organization: str, response: str) -> ProfessionalRelationPair | None:
+    person = parse_response(response)
+    return ProfessionalRelationPair(person, organization) if person is not None else None
+
+
 def query_person(organization: str, model_name: str = MODEL) -> ProfessionalRelationPair | None:
     model = OpenAIChatAPI(model=model_name)
-    response = parse_response(model.generate(get_person_query(organization)))
-    return ProfessionalRelationPair(response, organization) if response is not None else None
+    return parse_person_response(organization, model.generate(get_person_query(organization)))
 
 
 def get_person(organization: str, model_name: str = MODEL) -> ProfessionalRelationPair | None:
     return query_person(organization, model_name=model_name)
 
+
+def get_people(organizations: list[str], model_name: str = MODEL) -> list[ProfessionalRelationPair | None]:
+    """Batched `get_person`, querying all organizations concurrently."""
+    model = OpenAIChatAPI(model=model_name)
+    responses = model.generate_many([get_person_query(organization) for organization in organizations])
+    return [parse_person_response(organization, response) for organization, response in zip(organizations, responses)]
+
 @memory.cache
 def get_organization(
     person: str,